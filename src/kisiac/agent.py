@@ -0,0 +1,372 @@
+# The kisiac agent is shipped to remote hosts via func_to_sh and executed there
+# with python3. Hence, this module may only use the standard library and
+# must not import anything else from kisiac.
+#
+# Protocol: requests and responses are framed as one JSON object per line.
+# Requests are {"id": ..., "op": ..., "args": {...}}, responses are
+# {"id": ..., "ok": true, "result": ...} or {"id": ..., "ok": false,
+# "error": ...}. Requests are processed in order, so that clients may send
+# many of them before reading the responses (pipelining).
+#
+# Remote hosts may run older Python versions than the controller, so keep the
+# code compatible with Python 3.8.
+
+from __future__ import annotations
+
+import grp
+import hashlib
+import json
+import os
+import platform
+import pwd
+import queue
+import stat
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+
+def apply_symbolic_mode(mode: int, spec: str, is_dir: bool) -> int:
+    """Apply a chmod style symbolic mode (e.g. 'u=rw,g-rwx,o+X') to mode."""
+    masks = {"u": 0o4700, "g": 0o2070, "o": 0o1007}
+    for clause in spec.split(","):
+        i = 0
+        who = ""
+        while i < len(clause) and clause[i] in "ugoa":
+            who += clause[i]
+            i += 1
+        if not who or "a" in who:
+            who = "ugo"
+        if i == len(clause):
+            # like chmod, reject clauses without operator
+            raise ValueError(f"Invalid symbolic mode: {spec}")
+        while i < len(clause):
+            op = clause[i]
+            if op not in "+-=":
+                raise ValueError(f"Invalid symbolic mode: {spec}")
+            i += 1
+            perms = ""
+            while i < len(clause) and clause[i] not in "+-=":
+                perms += clause[i]
+                i += 1
+            bits = 0
+            for perm in perms:
+                if perm == "r":
+                    bits |= 0o444
+                elif perm == "w":
+                    bits |= 0o222
+                elif perm == "x":
+                    bits |= 0o111
+                elif perm == "X":
+                    if is_dir or mode & 0o111:
+                        bits |= 0o111
+                elif perm == "s":
+                    bits |= stat.S_ISUID | stat.S_ISGID
+                elif perm == "t":
+                    bits |= stat.S_ISVTX
+                else:
+                    raise ValueError(f"Invalid symbolic mode: {spec}")
+            affected = 0
+            for w in who:
+                affected |= masks[w]
+            if "t" in perms:
+                # the sticky bit is not bound to a particular user set
+                affected |= stat.S_ISVTX
+            bits &= affected
+            if op == "+":
+                mode |= bits
+            elif op == "-":
+                mode &= ~bits
+            else:
+                # like chmod, '=' keeps the setuid/setgid bits of directories
+                keep = stat.S_ISUID | stat.S_ISGID if is_dir else 0
+                mode = (mode & ~(affected & ~keep)) | bits
+    return mode
+
+
+def _path(path: str) -> str:
+    return os.path.expanduser(path)
+
+
+def _stat_entry(path: str) -> list[Any] | None:
+    try:
+        result = os.stat(_path(path))
+    except OSError:
+        return None
+    try:
+        owner = pwd.getpwuid(result.st_uid).pw_name
+    except KeyError:
+        owner = str(result.st_uid)
+    try:
+        group = grp.getgrgid(result.st_gid).gr_name
+    except KeyError:
+        group = str(result.st_gid)
+    return [
+        stat.S_ISDIR(result.st_mode),
+        stat.S_IMODE(result.st_mode),
+        owner,
+        group,
+        result.st_size,
+    ]
+
+
+def _checksum(path: str) -> str | None:
+    digest = hashlib.sha256()
+    try:
+        with open(_path(path), "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def op_stat(paths: list[str]) -> list[list[Any] | None]:
+    return [_stat_entry(path) for path in paths]
+
+
+def op_checksum(paths: list[str]) -> list[str | None]:
+    return [_checksum(path) for path in paths]
+
+
+def op_read(path: str) -> str:
+    with open(_path(path), "r") as f:
+        return f.read()
+
+
+def op_write(
+    path: str,
+    content: str,
+    mode: int | None = None,
+    owner: str | None = None,
+    group: str | None = None,
+) -> None:
+    path = _path(path)
+    with open(path, "w") as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+    if owner is not None or group is not None:
+        os.chown(path, *_ids(owner, group))
+
+
+def op_mkdir(path: str) -> None:
+    os.makedirs(_path(path), exist_ok=True)
+
+
+def _ids(owner: str | None, group: str | None) -> tuple[int, int]:
+    uid = pwd.getpwnam(owner).pw_uid if owner is not None else -1
+    gid = grp.getgrnam(group).gr_gid if group is not None else -1
+    return uid, gid
+
+
+def _fix_entry(
+    path: str, st: os.stat_result, mode: str | None, uid: int, gid: int
+) -> bool:
+    """Change mode and ownership of the entry if needed, return whether changed."""
+    changed = False
+    if (uid != -1 and st.st_uid != uid) or (gid != -1 and st.st_gid != gid):
+        os.lchown(path, uid, gid)
+        changed = True
+        # chown may clear setuid/setgid bits, hence chmod afterwards
+        st = os.lstat(path)
+    if mode is not None and not stat.S_ISLNK(st.st_mode):
+        current = stat.S_IMODE(st.st_mode)
+        new_mode = apply_symbolic_mode(current, mode, stat.S_ISDIR(st.st_mode))
+        if new_mode != current:
+            os.chmod(path, new_mode)
+            changed = True
+    return changed
+
+
+# seconds between progress reports of permissions_tree
+progress_interval = 10
+
+
+def op_permissions_tree(
+    path: str,
+    mode: str | None = None,
+    owner: str | None = None,
+    group: str | None = None,
+    workers: int = 8,
+) -> dict[str, Any]:
+    """Apply a symbolic mode and ownership to a whole tree.
+
+    The tree is traversed with os.scandir by parallel workers, and only
+    entries that differ from the desired state are changed. Symlinks are not
+    followed. Progress is reported on stderr.
+    """
+    root = _path(path)
+    uid, gid = _ids(owner, group)
+    start = time.monotonic()
+    lock = threading.Lock()
+    counts = {"scanned": 1, "changed": 0}
+    last_report = [start]
+    errors: list[str] = []
+
+    root_st = os.lstat(root)
+    if _fix_entry(root, root_st, mode, uid, gid):
+        counts["changed"] += 1
+
+    dirs: queue.Queue[str | None] = queue.Queue()
+    if stat.S_ISDIR(root_st.st_mode):
+        dirs.put(root)
+
+    def report() -> None:
+        elapsed = time.monotonic() - start
+        print(
+            f"[kisiac agent] {root}: scanned {counts['scanned']} entries, "
+            f"changed {counts['changed']} "
+            f"({counts['scanned'] / max(elapsed, 1e-9):.0f} entries/s)",
+            file=sys.stderr,
+            flush=True,
+        )
+
+    def work() -> None:
+        while True:
+            directory = dirs.get()
+            if directory is None:
+                return
+            scanned = changed = 0
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        st = entry.stat(follow_symlinks=False)
+                        scanned += 1
+                        if _fix_entry(entry.path, st, mode, uid, gid):
+                            changed += 1
+                        if stat.S_ISDIR(st.st_mode):
+                            dirs.put(entry.path)
+            except OSError as e:
+                with lock:
+                    errors.append(str(e))
+            finally:
+                with lock:
+                    counts["scanned"] += scanned
+                    counts["changed"] += changed
+                    now = time.monotonic()
+                    if now - last_report[0] >= progress_interval:
+                        last_report[0] = now
+                        report()
+                dirs.task_done()
+
+    threads = [threading.Thread(target=work) for _ in range(max(workers, 1))]
+    for thread in threads:
+        thread.start()
+    dirs.join()
+    for _ in threads:
+        dirs.put(None)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise OSError(
+            f"{len(errors)} errors while applying permissions to {root}, e.g. "
+            + "; ".join(errors[:5])
+        )
+    seconds = time.monotonic() - start
+    return {
+        "scanned": counts["scanned"],
+        "changed": counts["changed"],
+        "seconds": seconds,
+        "rate": counts["scanned"] / max(seconds, 1e-9),
+    }
+
+
+def _fix_path(path: str, mode: str | None, uid: int, gid: int) -> dict[str, Any]:
+    # like chmod and chown without -R, symlinks are followed
+    path = os.path.realpath(_path(path))
+    changed = _fix_entry(path, os.stat(path), mode, uid, gid)
+    return {"scanned": 1, "changed": int(changed)}
+
+
+def op_chmod(
+    path: str, mode: str, recursive: bool = False, workers: int = 8
+) -> dict[str, Any]:
+    if recursive:
+        return op_permissions_tree(path, mode=mode, workers=workers)
+    return _fix_path(path, mode, -1, -1)
+
+
+def op_chown(
+    path: str,
+    owner: str | None,
+    group: str | None,
+    recursive: bool = False,
+    workers: int = 8,
+) -> dict[str, Any]:
+    if recursive:
+        return op_permissions_tree(path, owner=owner, group=group, workers=workers)
+    return _fix_path(path, None, *_ids(owner, group))
+
+
+def op_exec(cmd: str, input: str | None = None) -> dict[str, Any]:
+    ret = subprocess.run(
+        cmd,
+        shell=True,
+        executable="/bin/bash",
+        input=input,
+        text=True,
+        capture_output=True,
+        # the return code is reported to the client
+        check=False,
+    )
+    return {"returncode": ret.returncode, "stdout": ret.stdout, "stderr": ret.stderr}
+
+
+def op_facts() -> dict[str, Any]:
+    os_release = {}
+    try:
+        with open("/etc/os-release", "r") as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep:
+                    os_release[key] = value.strip('"')
+    except OSError:
+        pass
+    return {
+        "hostname": platform.node(),
+        "kernel": platform.release(),
+        "python": platform.python_version(),
+        "os_release": os_release,
+        "users": sorted(entry.pw_name for entry in pwd.getpwall()),
+        "groups": sorted(entry.gr_name for entry in grp.getgrall()),
+    }
+
+
+ops: dict[str, Callable[..., Any]] = {
+    "stat": op_stat,
+    "checksum": op_checksum,
+    "read": op_read,
+    "write": op_write,
+    "mkdir": op_mkdir,
+    "chmod": op_chmod,
+    "chown": op_chown,
+    "permissions_tree": op_permissions_tree,
+    "exec": op_exec,
+    "facts": op_facts,
+}
+
+
+def serve() -> None:
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            result = ops[request["op"]](**request.get("args", {}))
+            response = {"id": request["id"], "ok": True, "result": result}
+        # Any failure of an op is reported as the response to its request.
+        # Letting it propagate would end the agent, such that all pipelined
+        # requests of the session would fail with a broken pipe.
+        except Exception as e:  # noqa: BLE001
+            response = {
+                "id": request["id"],
+                "ok": False,
+                "error": f"{type(e).__name__}: {e}",
+            }
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
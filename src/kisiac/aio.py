@@ -0,0 +1,379 @@
+# Asyncio based execution engine for updating many hosts from one event loop.
+#
+# Remote commands are run via asyncio subprocesses over the multiplexed SSH
+# connections. Phases without an async implementation are run in the default
+# thread pool executor, such that the synchronous API keeps working unchanged.
+
+import asyncio
+import subprocess as sp
+import weakref
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Self
+
+from kisiac import update, users
+from kisiac.common import (
+    ArchiveEntry,
+    PathStat,
+    SSHConnections,
+    StatCache,
+    UserError,
+    archive_cmd,
+    checksum_script,
+    cmd_user_error,
+    log_action,
+    parse_checksum_output,
+    parse_stat_output,
+    stat_chunk_size,
+    stat_script,
+    wrap_cmd,
+)
+from kisiac.config import Config, File, Ownership, plan_files
+from kisiac.filesystems import update_filesystems, update_permissions
+from kisiac.packages import provide_packages, repo_index_removal_cmds
+from kisiac.runtime_settings import UpdateHostSettings
+from kisiac.state import StateStore
+
+# upper bound for the number of concurrently running subprocesses, which
+# keeps memory and file descriptor usage in check
+max_processes = 256
+
+_process_limits: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, asyncio.Semaphore
+] = weakref.WeakKeyDictionary()
+
+
+def _process_limit() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _process_limits:
+        _process_limits[loop] = asyncio.Semaphore(max_processes)
+    return _process_limits[loop]
+
+
+async def _wrap_cmd(cmd: list[str], host: str, sudo: bool) -> list[str]:
+    if host != "localhost":
+        # Opening the master connection blocks, hence do it in a thread.
+        # Afterwards, wrap_cmd does not block anymore.
+        await asyncio.to_thread(SSHConnections.get_instance().connect, host)
+    return wrap_cmd(cmd, host=host, sudo=sudo)
+
+
+async def run_cmd(
+    cmd: list[str],
+    input: str | None = None,
+    host: str = "localhost",
+    sudo: bool = False,
+    user_error: bool = True,
+    check: bool = True,
+    keep_stat_cache: bool = False,
+) -> sp.CompletedProcess[str]:
+    """Async counterpart of kisiac.common.run_cmd."""
+    if not keep_stat_cache and (host != "localhost" or sudo):
+        StatCache.get_instance().clear(host)
+    cmd = await _wrap_cmd(list(map(str, cmd)), host=host, sudo=sudo)
+    log_action(host, "Running command", " ".join(cmd))
+    async with _process_limit():
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=sp.PIPE if input is not None else sp.DEVNULL,
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+        )
+        stdout, stderr = await process.communicate(
+            input.encode() if input is not None else None
+        )
+    assert process.returncode is not None
+    ret = sp.CompletedProcess(
+        cmd, process.returncode, stdout=stdout.decode(), stderr=stderr.decode()
+    )
+    if check and ret.returncode != 0:
+        e = sp.CalledProcessError(
+            ret.returncode, cmd, output=ret.stdout, stderr=ret.stderr
+        )
+        if user_error:
+            raise cmd_user_error(e) from e
+        raise e
+    return ret
+
+
+class HostAgnosticPath:
+    """Async counterpart of kisiac.common.HostAgnosticPath (remote or sudo)."""
+
+    def __init__(
+        self, path: str | Path, host: str = "localhost", sudo: bool = False
+    ) -> None:
+        self.path = Path(path)
+        self.host = host
+        self.sudo = sudo
+
+    async def _run_cmd(
+        self, cmd: list[str], input: str | None = None
+    ) -> sp.CompletedProcess[str]:
+        return await run_cmd(
+            cmd, input=input, host=self.host, sudo=self.sudo, keep_stat_cache=True
+        )
+
+    async def read_text(self) -> str:
+        return (await self._run_cmd(["cat", str(self.path)])).stdout
+
+    async def write_text(self, content: str) -> None:
+        StatCache.get_instance().invalidate(self.host, self.path)
+        await self._run_cmd(["tee", str(self.path)], input=content)
+
+    async def mkdir(self) -> None:
+        cache = StatCache.get_instance()
+        for path in [self.path, *self.path.parents]:
+            cache.invalidate(self.host, path)
+        await self._run_cmd(["mkdir", "-p", str(self.path)])
+
+    async def chmod(self, *mode: str, recursive: bool = True) -> None:
+        await self._chperm("chmod", ",".join(mode), recursive=recursive)
+
+    async def chown(self, user: str | None, group: str | None = None) -> None:
+        if user is not None:
+            await self._chperm("chown", f"{user}:{group}" if group else user)
+        elif group is not None:
+            await self._chperm("chgrp", group)
+        else:
+            raise ValueError("Either user or group must be provided.")
+
+    async def _chperm(self, cmd: str, arg: str, recursive: bool = True) -> None:
+        args = [arg]
+        recursive = recursive and await self.is_dir()
+        if recursive:
+            args = ["-R", *args]
+        StatCache.get_instance().invalidate(self.host, self.path, recursive=recursive)
+        await self._run_cmd([cmd, *args, str(self.path)])
+
+    async def stat(self) -> PathStat | None:
+        return (await stat_paths([self]))[0]
+
+    async def exists(self) -> bool:
+        return await self.stat() is not None
+
+    async def is_dir(self) -> bool:
+        entry = await self.stat()
+        return entry is not None and entry.is_dir
+
+    def __truediv__(self, other: Any) -> Self:
+        return type(self)(self.path / other, host=self.host, sudo=self.sudo)
+
+    def __str__(self) -> str:
+        return f"{self.host}:{self.path}"
+
+
+def _chunks(
+    paths: Sequence[HostAgnosticPath],
+) -> list[tuple[str, bool, list[tuple[int, HostAgnosticPath]]]]:
+    groups: dict[tuple[str, bool], list[tuple[int, HostAgnosticPath]]] = {}
+    for i, path in enumerate(paths):
+        groups.setdefault((path.host, path.sudo), []).append((i, path))
+    return [
+        (host, sudo, items[offset : offset + stat_chunk_size])
+        for (host, sudo), items in groups.items()
+        for offset in range(0, len(items), stat_chunk_size)
+    ]
+
+
+async def stat_paths(paths: Sequence[HostAgnosticPath]) -> list[PathStat | None]:
+    """Async counterpart of kisiac.common.stat_paths, stats chunks concurrently."""
+    cache = StatCache.get_instance()
+    results: dict[int, PathStat | None] = {}
+    pending = []
+    for i, path in enumerate(paths):
+        cached = cache.get(path.host, path.path)
+        if cached is not False:
+            results[i] = cached
+        else:
+            pending.append(path)
+    indices = [i for i in range(len(paths)) if i not in results]
+
+    async def stat_chunk(
+        host: str, sudo: bool, chunk: list[tuple[int, HostAgnosticPath]]
+    ) -> None:
+        ret = await run_cmd(
+            [stat_script([path.path for _, path in chunk])],
+            host=host,
+            sudo=sudo,
+            keep_stat_cache=True,
+        )
+        for (i, path), entry in zip(chunk, parse_stat_output(ret.stdout, chunk, host)):
+            cache.set(host, path.path, entry)
+            results[indices[i]] = entry
+
+    await asyncio.gather(*(stat_chunk(*chunk) for chunk in _chunks(pending)))
+    return [results[i] for i in range(len(paths))]
+
+
+async def checksum_paths(paths: Sequence[HostAgnosticPath]) -> list[str | None]:
+    """Async counterpart of kisiac.common.checksum_paths."""
+    results: dict[int, str | None] = {}
+
+    async def checksum_chunk(
+        host: str, sudo: bool, chunk: list[tuple[int, HostAgnosticPath]]
+    ) -> None:
+        ret = await run_cmd(
+            [checksum_script([path.path for _, path in chunk])],
+            host=host,
+            sudo=sudo,
+            keep_stat_cache=True,
+        )
+        digests = parse_checksum_output(ret.stdout, chunk, host)
+        results.update((i, digest) for (i, _), digest in zip(chunk, digests))
+
+    await asyncio.gather(*(checksum_chunk(*chunk) for chunk in _chunks(paths)))
+    return [results[i] for i in range(len(paths))]
+
+
+async def push_archive(entries: Sequence[ArchiveEntry], host: str, sudo: bool) -> None:
+    """Async counterpart of kisiac.common.push_archive."""
+    if not entries:
+        return
+    cmd, input = archive_cmd(entries, host=host, sudo=sudo)
+    cache = StatCache.get_instance()
+    for entry in entries:
+        cache.invalidate(host, entry.path)
+    await run_cmd(cmd, input=input, host=host, sudo=sudo, keep_stat_cache=True)
+
+
+async def write_files(
+    files: Sequence[tuple[File, Ownership]], overwrite_existing: bool, host: str
+) -> Sequence[Path]:
+    """Async counterpart of kisiac.config.write_files."""
+    paths = [path.path for file, _ in files for path in file.host_paths(host, True)]
+    stats = dict(
+        zip(
+            paths,
+            await stat_paths([HostAgnosticPath(p, host, sudo=True) for p in paths]),
+        )
+    )
+    existing = [file.target_path for file, _ in files if stats[file.target_path]]
+    digests = dict(
+        zip(
+            existing,
+            await checksum_paths(
+                [HostAgnosticPath(p, host, sudo=True) for p in existing]
+            ),
+        )
+    )
+    entries, written = plan_files(files, overwrite_existing, stats, digests)
+    await push_archive(entries, host=host, sudo=True)
+    return written
+
+
+async def _skip_phase(host: str, phase: str) -> tuple[bool, str | None]:
+    journal = StateStore.get_instance()
+    fingerprint = await asyncio.to_thread(journal.phase_fingerprint, host, phase)
+    skip = await asyncio.to_thread(journal.skip_phase, host, phase, fingerprint)
+    return skip, fingerprint
+
+
+async def update_system_files(host: str) -> None:
+    skip, fingerprint = await _skip_phase(host, "update_system_files")
+    if skip:
+        return
+    files = await asyncio.to_thread(update.system_files, host)
+    written = await write_files(files, overwrite_existing=True, host=host)
+    for path in written:
+        log_action(host, "Updated system file", path)
+    journal = StateStore.get_instance()
+    await asyncio.to_thread(journal.record_deployment, host, "update_system_files")
+    await asyncio.to_thread(
+        journal.record_phase,
+        host,
+        "update_system_files",
+        fingerprint,
+        f"{len(written)} files written",
+    )
+
+
+async def update_user_files(host: str) -> None:
+    skip, fingerprint = await _skip_phase(host, "update_user_files")
+    if skip:
+        return
+    files = await asyncio.to_thread(update.user_files, host)
+    written = await write_files(files, overwrite_existing=False, host=host)
+    for path in written:
+        log_action(host, "Updated user file", path)
+    journal = StateStore.get_instance()
+    await asyncio.to_thread(journal.record_deployment, host, "update_user_files")
+    await asyncio.to_thread(
+        journal.record_phase,
+        host,
+        "update_user_files",
+        fingerprint,
+        f"{len(written)} files written",
+    )
+
+
+async def update_system_packages(host: str) -> None:
+    skip, fingerprint = await _skip_phase(host, "update_system_packages")
+    if skip:
+        return
+    plan = await asyncio.to_thread(update.package_plan, host)
+    provided = plan.from_controller and bool(plan.missing or plan.upgrade)
+    try:
+        if provided:
+            await asyncio.to_thread(
+                provide_packages, host, plan.missing, plan.upgrade, plan.update_index
+            )
+        for cmd in update.system_packages_cmds(plan):
+            await run_cmd(cmd, sudo=True, host=host)
+    finally:
+        if provided and UpdateHostSettings.get_instance().package_repo is not None:
+            for cmd in repo_index_removal_cmds():
+                await run_cmd(cmd, sudo=True, host=host)
+    await asyncio.to_thread(
+        StateStore.get_instance().record_phase,
+        host,
+        "update_system_packages",
+        fingerprint,
+    )
+
+
+async def update_host(host: str) -> None:
+    """Async counterpart of kisiac.update.update_host."""
+    await update_system_files(host)
+
+    await update_system_packages(host)
+
+    # phases without native async implementation, adapted via threads
+    await asyncio.to_thread(update.update_lvm, host)
+
+    await asyncio.to_thread(update_filesystems, host)
+
+    await asyncio.to_thread(users.setup_users, host=host)
+
+    await asyncio.to_thread(update_permissions, host)
+
+    await update_user_files(host)
+
+    await asyncio.to_thread(users.setup_user_software, host)
+
+
+async def _update_hosts(hosts: Sequence[str], jobs: int) -> None:
+    limit = asyncio.Semaphore(jobs)
+
+    async def update_one(host: str) -> UserError | None:
+        async with limit:
+            try:
+                await update_host(host)
+            except UserError as e:
+                log_action(host, "Update failed:", e)
+                return e
+            return None
+
+    errors = await asyncio.gather(*map(update_one, hosts))
+    update.summarize_updates(dict(zip(hosts, errors)))
+
+
+def update_hosts(hosts: Sequence[str], jobs: int) -> None:
+    """Async counterpart of kisiac.update.update_hosts, using one event loop."""
+    if jobs < 1:
+        raise UserError("The number of jobs has to be at least 1.")
+    # Set up the config and settings before entering the event loop, such
+    # that no blocking setup happens inside of coroutines.
+    Config.get_instance().for_hosts(hosts)
+    UpdateHostSettings.get_instance()
+    StateStore.get_instance()
+    asyncio.run(_update_hosts(hosts, jobs))
@@ -1,11 +1,12 @@
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
-from kisiac.common import UserError, log_msg
+from kisiac import aio
+from kisiac.common import Agents, SSHConnections, UserError, log_msg
 from kisiac.runtime_settings import (
     GlobalSettings,
     UpdateHostSettings,
 )
-from kisiac.update import setup_config, update_host
+from kisiac.update import setup_config, update_hosts
 
 
 def get_argument_parser() -> ArgumentParser:
@@ -35,9 +36,11 @@ def main() -> None:
         GlobalSettings.from_cli_args(args)
         match args.subcommand:
             case "update-hosts":
-                UpdateHostSettings.from_cli_args(args)
-                for host in UpdateHostSettings.get_instance().hosts:
-                    update_host(host)
+                settings = UpdateHostSettings.from_cli_args(args)
+                if settings.asyncio:
+                    aio.update_hosts(settings.hosts, jobs=settings.jobs)
+                else:
+                    update_hosts(settings.hosts, jobs=settings.jobs)
             case "setup-config":
                 setup_config()
             case _:
@@ -45,3 +48,6 @@ def main() -> None:
     except UserError as e:
         log_msg(e)
         exit(1)
+    finally:
+        Agents.get_instance().close()
+        SSHConnections.get_instance().close()
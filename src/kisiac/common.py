@@ -1,16 +1,38 @@
+import base64
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+import grp
+import hashlib
+import io
+import json
+import os
 from pathlib import Path
+import shlex
+import shutil
+import stat
 import subprocess as sp
 import sys
-from typing import Any, Callable, Self, Sequence
+import tarfile
+import tempfile
+import threading
+import time
+from types import TracebackType
+from typing import Any, Callable, Iterator, Literal, Self, Sequence
 import importlib
+import importlib.metadata
+import pwd
 import re
-import textwrap
 
 import inquirer
 
+from kisiac.agent import apply_symbolic_mode
+
 
 cache = Path("~/.cache/kisiac").expanduser()
 
+kisiac_version = importlib.metadata.version("kisiac")
+
 
 def handle_key_error(msg: str) -> Callable:
     def decoator(func: Callable) -> Callable:
@@ -25,23 +47,37 @@ def handle_key_error(msg: str) -> Callable:
     return decoator
 
 
+# Reentrant, since singletons may access other singletons while being created.
+_singleton_lock = threading.RLock()
+
+
 class Singleton:
     @classmethod
     def get_instance(cls, *args, **kwargs) -> Self:
-        if not hasattr(cls, "_instance") or cls._instance is None:
-            cls._instance = cls(*args, **kwargs)
+        # Checking "_instance" in the class dict instead of hasattr ensures that
+        # subclasses do not pick up the instance of a parent class.
+        if cls.__dict__.get("_instance") is None:
+            with _singleton_lock:
+                if cls.__dict__.get("_instance") is None:
+                    cls._instance = cls(*args, **kwargs)
         return cls._instance
 
 
+# serializes prompts and log lines of concurrent host updates
+_prompt_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+
 def confirm_action(desc: str) -> bool:
     from kisiac.runtime_settings import GlobalSettings
 
     if GlobalSettings.get_instance().non_interactive:
         return True
 
-    response = inquirer.prompt(
-        [inquirer.Checkbox("action", message=desc, choices=["yes", "no"])]
-    )
+    with _prompt_lock:
+        response = inquirer.prompt(
+            [inquirer.Checkbox("action", message=desc, choices=["yes", "no"])]
+        )
     assert response is not None
     return response["action"] == "yes"
 
@@ -55,7 +91,9 @@ def exists_cmd(cmd: str, host: str, sudo: bool) -> bool:
 
 
 def log_msg(*msgs: Any) -> None:
-    print(" ".join(map(str, msgs)), file=sys.stderr)
+    msg = " ".join(map(str, msgs))
+    with _log_lock:
+        print(msg, file=sys.stderr)
 
 
 def log_action(host: str, *msgs: Any) -> None:
@@ -74,17 +112,25 @@ def run_cmd(
     sudo: bool = False,
     user_error: bool = True,
     check: bool = True,
+    keep_stat_cache: bool = False,
+    use_agent: bool = True,
 ) -> sp.CompletedProcess[str]:
-    """Run a system command using subprocess.run and check for errors."""
+    """Run a system command using subprocess.run and check for errors.
+
+    Unless keep_stat_cache is set, cached path metadata of the host is dropped,
+    since arbitrary commands may modify the filesystem.
+    The agent serves one request at a time, hence long running commands that
+    shall run concurrently have to bypass it by unsetting use_agent. They
+    then get their own session on the multiplexed ssh connection.
+    """
+    if not keep_stat_cache and (host != "localhost" or sudo):
+        StatCache.get_instance().clear(host)
     # TODO check quotation!
     cmd = list(map(str, cmd))
-    if sudo:
-        cmd = ["sudo", "bash", "-c", f"{' '.join(cmd)}"]
-    if host != "localhost":
-        if sudo:
-            cmd = ["ssh", host, f"sudo bash -c '{' '.join(cmd)}'"]
-        else:
-            cmd = ["ssh", host, f"{' '.join(cmd)}"]
+    agent = Agents.get_instance().get(host, sudo) if use_agent else None
+    if agent is not None:
+        return _run_cmd_via_agent(agent, cmd, input, user_error, check)
+    cmd = wrap_cmd(cmd, host=host, sudo=sudo)
     log_action(host, "Running command", cmd_to_str(cmd))
     try:
         return sp.run(
@@ -98,13 +144,451 @@ def run_cmd(
         )
     except sp.CalledProcessError as e:
         if user_error:
-            raise UserError(
-                f"Error occurred while running command '{' '.join(cmd)}': {e.stderr}"
-            ) from e
+            raise cmd_user_error(e) from e
         else:
             raise
 
 
+def wrap_cmd(cmd: list[str], host: str, sudo: bool) -> list[str]:
+    """Wrap the command for running it via sudo and/or ssh on the given host."""
+    if sudo:
+        cmd = ["sudo", "bash", "-c", f"{' '.join(cmd)}"]
+    if host != "localhost":
+        ssh = SSHConnections.get_instance().ssh_cmd(host)
+        if sudo:
+            # quote the sudo wrapper as a whole, such that the remote shell
+            # hands the command string to bash -c as a single argument
+            cmd = [*ssh, shlex.join(cmd)]
+        else:
+            cmd = [*ssh, f"{' '.join(cmd)}"]
+    return cmd
+
+
+def cmd_user_error(e: sp.CalledProcessError) -> "UserError":
+    cmd = " ".join(map(str, e.cmd))
+    return UserError(f"Error occurred while running command '{cmd}': {e.stderr}")
+
+
+def _run_cmd_via_agent(
+    agent: "Agent",
+    cmd: list[str],
+    input: str | None,
+    user_error: bool,
+    check: bool,
+) -> sp.CompletedProcess[str]:
+    # the agent runs the command string with bash, as sudo bash -c would do
+    cmd_str = " ".join(cmd)
+    log_action(agent.host, "Running command via agent", cmd_str)
+    result = agent.call("exec", cmd=cmd_str, input=input)
+    ret = sp.CompletedProcess(
+        cmd, result["returncode"], stdout=result["stdout"], stderr=result["stderr"]
+    )
+    if check and ret.returncode != 0:
+        e = sp.CalledProcessError(
+            ret.returncode, cmd, output=ret.stdout, stderr=ret.stderr
+        )
+        if user_error:
+            raise cmd_user_error(e) from e
+        else:
+            raise e
+    return ret
+
+
+class CommandBatch:
+    """Collect commands and run them as a single bash script on the host.
+
+    Commands are executed in order. As with run_cmd, execution stops at the
+    first failing command for which check is set, and that failure is raised
+    like run_cmd would raise it. The batch is run when leaving the context.
+    """
+
+    def __init__(self, host: str = "localhost", sudo: bool = False) -> None:
+        self.host = host
+        self.sudo = sudo
+        self._cmds: list[tuple[list[str], str | None, bool, bool]] = []
+        self.results: list[sp.CompletedProcess[str]] = []
+
+    def add(
+        self,
+        cmd: list[str],
+        input: str | None = None,
+        user_error: bool = True,
+        check: bool = True,
+    ) -> None:
+        self._cmds.append((list(map(str, cmd)), input, user_error, check))
+
+    def __len__(self) -> int:
+        return len(self._cmds)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        if exc_type is None:
+            self.run()
+
+    @staticmethod
+    def _script(cmds: list[tuple[list[str], str | None, bool, bool]]) -> str:
+        lines = ["d=$(mktemp -d)", "trap 'rm -rf \"$d\"' EXIT"]
+        for i, (cmd, input, _, check) in enumerate(cmds):
+            stdin = "/dev/null"
+            if input is not None:
+                encoded = base64.b64encode(input.encode()).decode()
+                lines.append(f'echo {encoded} | base64 -d > "$d/i"')
+                stdin = '"$d/i"'
+            # Commands must not read the script itself from stdin. Stdout and
+            # stderr are reported base64 encoded, one line per command. Like
+            # with run_cmd, each command runs in its own shell, such that e.g.
+            # exit only ends the command itself.
+            lines.append(f'( {" ".join(cmd)}\n) > "$d/o" 2> "$d/e" < {stdin}')
+            lines.append(
+                f"rc=$?; printf '%s %s %s %s\\n' {i} $rc "
+                '"$(base64 -w0 "$d/o")" "$(base64 -w0 "$d/e")"'
+            )
+            if check:
+                lines.append("[ $rc -eq 0 ] || exit 0")
+        return "\n".join(lines) + "\n"
+
+    def run(self) -> list[sp.CompletedProcess[str]]:
+        """Run all collected commands and return the results of the executed ones."""
+        if not self._cmds:
+            return []
+        cmds, self._cmds = self._cmds, []
+        log_action(
+            self.host,
+            f"Running batch of {len(cmds)} commands:\n"
+            + cmd_to_str(*(cmd for cmd, *_ in cmds)),
+        )
+        script = self._script(cmds)
+        output = run_cmd(
+            ["bash", "-s"], input=script, host=self.host, sudo=self.sudo
+        ).stdout
+        self.results = []
+        for line in output.splitlines():
+            i, returncode, stdout, stderr = line.split(" ")
+            cmd, _, user_error, check = cmds[int(i)]
+            ret = sp.CompletedProcess(
+                cmd,
+                int(returncode),
+                stdout=base64.b64decode(stdout).decode(),
+                stderr=base64.b64decode(stderr).decode(),
+            )
+            self.results.append(ret)
+            if check and ret.returncode != 0:
+                e = sp.CalledProcessError(
+                    ret.returncode, cmd, output=ret.stdout, stderr=ret.stderr
+                )
+                if user_error:
+                    raise cmd_user_error(e) from e
+                raise e
+        return self.results
+
+
+class SSHConnections(Singleton):
+    """Multiplexed SSH sessions, one ControlMaster connection per host.
+
+    The master connection is opened on first use of a host and reused by all
+    subsequent ssh invocations until close() is called.
+    """
+
+    def __init__(self) -> None:
+        self._control_dir: Path | None = None
+        # host -> whether a master connection could be established
+        self._masters: dict[str, bool] = {}
+        self._invocations: dict[str, int] = defaultdict(int)
+        self._host_locks: dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def connect(self, host: str) -> bool:
+        """Open the master connection if needed and return whether it is open."""
+        with self._lock:
+            host_lock = self._host_locks[host]
+        with host_lock:
+            if host not in self._masters:
+                self._masters[host] = self._open(host)
+            return self._masters[host]
+
+    def ssh_cmd(self, host: str) -> list[str]:
+        is_open = self.connect(host)
+        with self._lock:
+            self._invocations[host] += 1
+        if is_open:
+            return ["ssh", "-o", f"ControlPath={self._control_path()}", host]
+        else:
+            return ["ssh", host]
+
+    def _control_path(self) -> str:
+        with self._lock:
+            if self._control_dir is None:
+                self._control_dir = Path(tempfile.mkdtemp(prefix="kisiac-ssh-"))
+        # %C is a hash of the connection parameters, which keeps the socket
+        # path short enough for the unix socket path limit
+        return str(self._control_dir / "%C")
+
+    def _open(self, host: str) -> bool:
+        log_action(host, "Opening multiplexed SSH connection")
+        ret = sp.run(
+            [
+                "ssh",
+                "-o",
+                "ControlMaster=yes",
+                "-o",
+                "ControlPersist=yes",
+                "-o",
+                f"ControlPath={self._control_path()}",
+                "-f",
+                "-N",
+                host,
+            ],
+            text=True,
+            capture_output=True,
+            # failures are handled by falling back to plain connections
+            check=False,
+        )
+        if ret.returncode != 0:
+            log_action(
+                host,
+                "Unable to open multiplexed SSH connection, falling back to "
+                f"one connection per command: {ret.stderr.strip()}",
+            )
+            return False
+        return True
+
+    def stats(self) -> dict[str, tuple[int, int]]:
+        """Return the number of ssh invocations and handshakes per host."""
+        with self._lock:
+            return {
+                host: (count, 1 if self._masters.get(host) else count)
+                for host, count in self._invocations.items()
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            masters = [host for host, is_open in self._masters.items() if is_open]
+        for host in masters:
+            ret = sp.run(
+                [
+                    "ssh",
+                    "-o",
+                    f"ControlPath={self._control_path()}",
+                    "-O",
+                    "exit",
+                    host,
+                ],
+                text=True,
+                capture_output=True,
+                # a master that cannot be stopped must not fail the whole run
+                check=False,
+            )
+            if ret.returncode != 0:
+                log_action(
+                    host,
+                    f"Unable to close multiplexed SSH connection: {ret.stderr.strip()}",
+                )
+        for host, (invocations, handshakes) in self.stats().items():
+            log_action(
+                host,
+                f"SSH: {invocations} commands over {handshakes} handshakes "
+                f"({invocations - handshakes} handshakes saved)",
+            )
+        with self._lock:
+            self._masters.clear()
+            self._invocations.clear()
+            if self._control_dir is not None:
+                shutil.rmtree(self._control_dir, ignore_errors=True)
+                self._control_dir = None
+
+
+class Agent:
+    """Client for a kisiac agent (see kisiac.agent) running on a host.
+
+    The agent is started via the multiplexed SSH connection of the host and
+    answers requests until close() is called.
+    """
+
+    def __init__(self, host: str, sudo: bool, tree_workers: int = 8) -> None:
+        from kisiac.agent import serve
+
+        self.host = host
+        self.sudo = sudo
+        # number of parallel workers for recursive permission changes
+        self.tree_workers = tree_workers
+        code = base64.b64encode(func_to_sh(serve).encode()).decode()
+        cmd = [
+            "python3",
+            "-u",
+            "-c",
+            f"import base64; exec(base64.b64decode('{code}'))",
+        ]
+        if sudo:
+            cmd = ["sudo", *cmd]
+        if host != "localhost":
+            cmd = [*SSHConnections.get_instance().ssh_cmd(host), shlex.join(cmd)]
+        self._process = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, text=True)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def call_many(self, requests: Sequence[tuple[str, dict[str, Any]]]) -> list[Any]:
+        """Send all requests at once and return their results in order."""
+        assert self._process.stdin is not None and self._process.stdout is not None
+        stdin, stdout = self._process.stdin, self._process.stdout
+        with self._lock:
+            ids = list(range(self._next_id, self._next_id + len(requests)))
+            self._next_id += len(requests)
+
+            def send() -> None:
+                try:
+                    for id, (op, args) in zip(ids, requests):
+                        stdin.write(json.dumps({"id": id, "op": op, "args": args}))
+                        stdin.write("\n")
+                    stdin.flush()
+                except BrokenPipeError:
+                    # reported below when reading the responses
+                    pass
+
+            # send from a separate thread, such that neither side blocks on
+            # full pipe buffers while the other one waits
+            sender = threading.Thread(target=send)
+            sender.start()
+            responses = {}
+            for _ in ids:
+                line = stdout.readline()
+                if not line:
+                    sender.join()
+                    raise UserError(
+                        f"kisiac agent on {self.host} terminated unexpectedly"
+                    )
+                response = json.loads(line)
+                responses[response["id"]] = response
+            sender.join()
+
+        results = []
+        for id, (op, _) in zip(ids, requests):
+            response = responses[id]
+            if not response["ok"]:
+                raise UserError(
+                    f"kisiac agent on {self.host} failed to run {op}: "
+                    f"{response['error']}"
+                )
+            results.append(response["result"])
+        return results
+
+    def call(self, op: str, **args: Any) -> Any:
+        return self.call_many([(op, args)])[0]
+
+    def permissions_tree(
+        self,
+        path: Path,
+        mode: str | None = None,
+        owner: str | None = None,
+        group: str | None = None,
+    ) -> None:
+        """Apply mode and ownership to the whole tree below path."""
+        self.log_tree_stats(
+            path,
+            self.call(
+                "permissions_tree",
+                path=str(path),
+                mode=mode,
+                owner=owner,
+                group=group,
+                workers=self.tree_workers,
+            ),
+        )
+
+    def log_tree_stats(self, path: Path, stats: dict[str, Any]) -> None:
+        log_action(
+            self.host,
+            f"Checked permissions of {stats['scanned']} entries below {path}, "
+            f"changed {stats['changed']} "
+            f"({stats['seconds']:.1f}s, {stats['rate']:.0f} entries/s)",
+        )
+
+    def close(self) -> None:
+        assert self._process.stdin is not None
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self._process.wait(timeout=10)
+        except sp.TimeoutExpired:
+            self._process.kill()
+
+
+class Agents(Singleton):
+    """Registry of the running kisiac agents, one per host and sudo mode."""
+
+    def __init__(self) -> None:
+        self._agents: dict[tuple[str, bool], Agent] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str, sudo: bool) -> Agent | None:
+        with self._lock:
+            return self._agents.get((host, sudo))
+
+    def start(self, host: str, sudo: bool, tree_workers: int = 8) -> Agent | None:
+        agent = self.get(host, sudo)
+        if agent is not None:
+            return agent
+        log_action(host, "Starting kisiac agent")
+        agent = Agent(host, sudo, tree_workers=tree_workers)
+        try:
+            # check that the agent is up and running
+            agent.call("facts")
+        except UserError:
+            agent.close()
+            log_action(
+                host,
+                "Unable to start kisiac agent (is python3 available?), "
+                "falling back to individual commands",
+            )
+            return None
+        with self._lock:
+            self._agents[(host, sudo)] = agent
+        return agent
+
+    def stop(self, host: str, sudo: bool) -> None:
+        with self._lock:
+            agent = self._agents.pop((host, sudo), None)
+        if agent is not None:
+            agent.close()
+
+    def close(self) -> None:
+        with self._lock:
+            agents = list(self._agents.values())
+            self._agents.clear()
+        for agent in agents:
+            agent.close()
+
+
+@contextmanager
+def agent_session(host: str, sudo: bool = True) -> Iterator[Agent | None]:
+    """Keep a kisiac agent running on the host while the context is active.
+
+    While the agent runs, run_cmd and HostAgnosticPath use it transparently.
+    """
+    from kisiac.runtime_settings import UpdateHostSettings
+
+    settings = UpdateHostSettings.get_instance()
+    if settings.no_agent:
+        yield None
+        return
+
+    agents = Agents.get_instance()
+    agent = agents.start(host, sudo, tree_workers=settings.permission_workers)
+    try:
+        yield agent
+    finally:
+        if agent is not None:
+            agents.stop(host, sudo)
+
+
 class UserError(Exception):
     """Base class for user-related errors."""
 
@@ -127,10 +611,7 @@ module_import_re: re.Pattern = re.compile(
 def func_to_sh(func: Callable) -> str:
     func_name = func.__name__
     module_code = get_module_code(func.__module__)
-    return textwrap.dedent(f"""
-    {module_code}
-    {func_name}()
-    """)
+    return f"{module_code}\n{func_name}()\n"
 
 
 def get_module_code(module_name: str) -> str:
@@ -145,6 +626,520 @@ def get_module_code(module_name: str) -> str:
     return module_code
 
 
+@dataclass(frozen=True)
+class PathStat:
+    is_dir: bool
+    # permission bits, including setuid, setgid and sticky bit
+    mode: int
+    owner: str
+    group: str
+    size: int
+
+    @classmethod
+    def from_stat_result(cls, result: os.stat_result) -> Self:
+        try:
+            owner = pwd.getpwuid(result.st_uid).pw_name
+        except KeyError:
+            owner = str(result.st_uid)
+        try:
+            group = grp.getgrgid(result.st_gid).gr_name
+        except KeyError:
+            group = str(result.st_gid)
+        return cls(
+            is_dir=stat.S_ISDIR(result.st_mode),
+            mode=stat.S_IMODE(result.st_mode),
+            owner=owner,
+            group=group,
+            size=result.st_size,
+        )
+
+
+class StatCache(Singleton):
+    """Per-run cache of path metadata on remote hosts or accessed via sudo.
+
+    Entries are dropped whenever kisiac modifies the corresponding paths, and
+    all entries of a host are dropped when arbitrary commands are run on it.
+    """
+
+    def __init__(self) -> None:
+        # (host, path) -> stat result or None if the path does not exist
+        self._entries: dict[tuple[str, str], PathStat | None] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str, path: Path) -> PathStat | None | Literal[False]:
+        """Return the cached entry or False if the path is not cached."""
+        with self._lock:
+            return self._entries.get((host, str(path)), False)
+
+    def set(self, host: str, path: Path, entry: PathStat | None) -> None:
+        with self._lock:
+            self._entries[(host, str(path))] = entry
+
+    def invalidate(self, host: str, path: Path, recursive: bool = False) -> None:
+        with self._lock:
+            self._entries.pop((host, str(path)), None)
+            if recursive:
+                for key in list(self._entries):
+                    if key[0] == host and Path(key[1]).is_relative_to(path):
+                        del self._entries[key]
+
+    def clear(self, host: str) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == host:
+                    del self._entries[key]
+
+
+# number of paths to stat with a single command, avoiding too long command lines
+stat_chunk_size = 1000
+
+
+def shell_path(path: Path | str) -> str:
+    """Quote a path for the shell while keeping a leading ~user expandable."""
+    path = str(path)
+    if path.startswith("~"):
+        home, sep, rest = path.partition("/")
+        return home + sep + (shlex.quote(rest) if rest else "")
+    return shlex.quote(path)
+
+
+def stat_script(paths: Sequence[Path]) -> str:
+    # One line per path, "-" for missing paths. Word splitting of the loop
+    # list keeps ~user expansion working.
+    return (
+        "for p in "
+        + " ".join(map(shell_path, paths))
+        + '; do stat -L --format=%f:%U:%G:%s "$p" 2>/dev/null || echo -; done'
+    )
+
+
+def parse_stat_output(
+    output: str, paths: Sequence[Any], host: str
+) -> list[PathStat | None]:
+    lines = output.splitlines()
+    if len(lines) != len(paths):
+        raise UserError(f"Unexpected output of stat on {host}: {output}")
+    entries = []
+    for line in lines:
+        entry = None
+        if line != "-":
+            raw_mode, owner, group, size = line.split(":")
+            mode = int(raw_mode, 16)
+            entry = PathStat(
+                is_dir=stat.S_ISDIR(mode),
+                mode=stat.S_IMODE(mode),
+                owner=owner,
+                group=group,
+                size=int(size),
+            )
+        entries.append(entry)
+    return entries
+
+
+def checksum_script(paths: Sequence[Path]) -> str:
+    # one line per path, "-" for missing or unreadable files
+    return (
+        "for p in "
+        + " ".join(map(shell_path, paths))
+        + '; do sha256sum < "$p" 2>/dev/null || echo -; done'
+    )
+
+
+def parse_checksum_output(
+    output: str, paths: Sequence[Any], host: str
+) -> list[str | None]:
+    lines = output.splitlines()
+    if len(lines) != len(paths):
+        raise UserError(f"Unexpected output of sha256sum on {host}: {output}")
+    return [None if line == "-" else line.split()[0] for line in lines]
+
+
+def stat_paths(paths: Sequence["HostAgnosticPath"]) -> list[PathStat | None]:
+    """Stat the given paths, using a single command per host and chunk.
+
+    Results are stored in the per-run StatCache. None denotes a missing path.
+    """
+    cache = StatCache.get_instance()
+    results: dict[int, PathStat | None] = {}
+    pending: dict[tuple[str, bool], list[tuple[int, HostAgnosticPath]]] = defaultdict(
+        list
+    )
+    for i, path in enumerate(paths):
+        if path.is_local_and_user():
+            results[i] = path._local_stat()
+            continue
+        cached = cache.get(path.host, path.path)
+        if cached is not False:
+            results[i] = cached
+        else:
+            pending[(path.host, path.sudo)].append((i, path))
+
+    for (host, sudo), items in pending.items():
+        agent = Agents.get_instance().get(host, sudo)
+        if agent is not None:
+            entries = agent.call("stat", paths=[str(path.path) for _, path in items])
+            for (i, path), raw in zip(items, entries):
+                entry = PathStat(*raw) if raw is not None else None
+                cache.set(host, path.path, entry)
+                results[i] = entry
+            continue
+        for offset in range(0, len(items), stat_chunk_size):
+            chunk = items[offset : offset + stat_chunk_size]
+            output = run_cmd(
+                [stat_script([path.path for _, path in chunk])],
+                host=host,
+                sudo=sudo,
+                keep_stat_cache=True,
+            ).stdout
+            for (i, path), entry in zip(chunk, parse_stat_output(output, chunk, host)):
+                cache.set(host, path.path, entry)
+                results[i] = entry
+
+    return [results[i] for i in range(len(paths))]
+
+
+def checksum_paths(paths: Sequence["HostAgnosticPath"]) -> list[str | None]:
+    """Return SHA-256 hex digests of the given files, using one command per host.
+
+    None denotes a missing or unreadable file.
+    """
+    results: dict[int, str | None] = {}
+    pending: dict[tuple[str, bool], list[tuple[int, HostAgnosticPath]]] = defaultdict(
+        list
+    )
+    for i, path in enumerate(paths):
+        if path.is_local_and_user():
+            try:
+                with open(path.path, "rb") as f:
+                    results[i] = hashlib.file_digest(f, "sha256").hexdigest()
+            except OSError:
+                results[i] = None
+        else:
+            pending[(path.host, path.sudo)].append((i, path))
+
+    for (host, sudo), items in pending.items():
+        agent = Agents.get_instance().get(host, sudo)
+        if agent is not None:
+            digests = agent.call(
+                "checksum", paths=[str(path.path) for _, path in items]
+            )
+            results.update((i, digest) for (i, _), digest in zip(items, digests))
+            continue
+        for offset in range(0, len(items), stat_chunk_size):
+            chunk = items[offset : offset + stat_chunk_size]
+            output = run_cmd(
+                [checksum_script([path.path for _, path in chunk])],
+                host=host,
+                sudo=sudo,
+                keep_stat_cache=True,
+            ).stdout
+            digests = parse_checksum_output(output, chunk, host)
+            results.update((i, digest) for (i, _), digest in zip(chunk, digests))
+
+    return [results[i] for i in range(len(paths))]
+
+
+@dataclass(frozen=True)
+class ArchiveEntry:
+    path: Path
+    # None for directories
+    content: str | None
+    mode: int
+    owner: str
+    group: str
+
+
+def push_archive(entries: Sequence[ArchiveEntry], host: str, sudo: bool) -> None:
+    """Write the given files and directories with a single compressed tar stream.
+
+    Entries are created in the given order, so parents have to come first.
+    Absolute paths are kept, relative paths are resolved against the working
+    directory of the remote shell. Existing symlinks are followed, i.e. the
+    entries are written to their targets.
+    """
+    if not entries:
+        return
+    cmd, input = archive_cmd(entries, host=host, sudo=sudo)
+    cache = StatCache.get_instance()
+    for entry in entries:
+        cache.invalidate(host, entry.path)
+    run_cmd(cmd, input=input, host=host, sudo=sudo, keep_stat_cache=True)
+
+
+# Unpacks an archive of push_archive into a temporary directory and installs
+# the entries at their paths in the order of the manifest. Files are copied onto their
+# paths, such that existing symlinks (e.g. /etc/resolv.conf) are kept and the
+# files they point to are written instead. Likewise, symlinked directories are
+# kept and their targets get the mode and ownership of the entry.
+unpack_archive_script = """set -e
+d=$(mktemp -d)
+trap 'rm -rf "$d"' EXIT
+base64 -d | tar -xzpf - --same-owner -C "$d"
+i=0
+while IFS= read -r path
+do
+  if [ -d "$d/$i" ]
+  then
+    mkdir -p "$path"
+    chown --reference="$d/$i" "$path"
+    chmod --reference="$d/$i" "$path"
+  else
+    cp --preserve=mode,ownership "$d/$i" "$path"
+  fi
+  i=$((i + 1))
+done < "$d/manifest"
+"""
+
+
+def archive_cmd(
+    entries: Sequence[ArchiveEntry], host: str, sudo: bool
+) -> tuple[list[str], str]:
+    """Return the command for unpacking the entries and its base64 encoded input.
+
+    The archive members are named by the index of their entry, the manifest
+    lists the paths of the entries in the same order.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        manifest = "".join(f"{entry.path}\n" for entry in entries).encode()
+        info = tarfile.TarInfo("manifest")
+        info.size = len(manifest)
+        archive.addfile(info, io.BytesIO(manifest))
+        for i, entry in enumerate(entries):
+            info = tarfile.TarInfo(str(i))
+            info.mode = entry.mode
+            info.uname = entry.owner
+            info.gname = entry.group
+            info.mtime = int(time.time())
+            if entry.content is None:
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            else:
+                content = entry.content.encode()
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+
+    if host == "localhost" and not sudo:
+        cmd = ["bash", "-c", unpack_archive_script]
+    else:
+        cmd = [unpack_archive_script]
+    return cmd, base64.encodebytes(buffer.getvalue()).decode()
+
+
+def stream_files(files: Sequence[tuple[Path, Path]], host: str, sudo: bool) -> None:
+    """Copy the given local files to the given paths on the host.
+
+    Unlike push_archive, the files are streamed as an uncompressed tar over
+    the (multiplexed) ssh connection instead of being encoded in memory and
+    passed through the agent, which suits large binary files. The files
+    are owned by root and readable by everybody.
+    """
+    if not files:
+        return
+    cmd = wrap_cmd(["tar", "-xpPf", "-", "--same-owner"], host=host, sudo=sudo)
+    log_action(host, "Streaming", f"{len(files)} files")
+    cache = StatCache.get_instance()
+    for _, target in files:
+        cache.invalidate(host, target)
+
+    def owned_by_root(info: tarfile.TarInfo) -> tarfile.TarInfo:
+        # tarfile strips the leading slash of absolute arcnames
+        info.name = "/" + info.name
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        info.mode = 0o644
+        return info
+
+    with tempfile.TemporaryFile() as stderr:
+        proc = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.DEVNULL, stderr=stderr)
+        assert proc.stdin is not None
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as archive:
+                for source, target in files:
+                    archive.add(source, arcname=str(target), filter=owned_by_root)
+        except BrokenPipeError:
+            # the remote tar exited early, its error message is reported below
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = proc.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise UserError(
+                f"Error occurred while streaming files to {host}: "
+                f"{stderr.read().decode(errors='replace')}"
+            )
+
+
+@dataclass(frozen=True)
+class PermissionTarget:
+    path: Path
+    # symbolic chmod modes, applied depending on the type of the path
+    file_mode: str | None
+    dir_mode: str | None
+    owner: str | None
+    group: str | None
+    # apply to the contents of directories as well (like chmod -R)
+    recursive: bool = True
+
+
+def apply_permissions(targets: Sequence[PermissionTarget], host: str) -> list[int]:
+    """Apply modes and ownership to many paths at once (with sudo).
+
+    Only entries whose current mode or ownership differs are changed. File
+    types are determined with one stat pass, and all changes are applied with
+    a single remote call. With an agent, each recursive target is handled by
+    one parallel walk of its tree. Otherwise, find selects the differing
+    entries of the tree. Returns the number of changes of each target.
+    """
+    if not targets:
+        return []
+    paths = [HostAgnosticPath(target.path, host=host, sudo=True) for target in targets]
+    stats = stat_paths(paths)
+    agent = Agents.get_instance().get(host, sudo=True)
+    requests: list[tuple[str, dict[str, Any]]] = []
+    # index of the target of each request
+    request_targets = []
+    batch = CommandBatch(host=host, sudo=True)
+    # index of the command and of the target of each tree in the batch
+    batch_trees = []
+    changes = [0] * len(targets)
+    # state of the paths after the preceding targets
+    current: dict[Path, PathStat] = {}
+    cache = StatCache.get_instance()
+    for i, (target, entry) in enumerate(zip(targets, stats)):
+        if entry is None:
+            raise UserError(f"Cannot set permissions of missing path {target.path}")
+        entry = current.get(target.path, entry)
+        mode = target.dir_mode if entry.is_dir else target.file_mode
+        recursive = target.recursive and entry.is_dir
+        new_mode = entry.mode
+        if mode is not None:
+            new_mode = apply_symbolic_mode(entry.mode, mode, entry.is_dir)
+        owner = target.owner if target.owner not in (None, entry.owner) else None
+        group = target.group if target.group not in (None, entry.group) else None
+        current[target.path] = replace(
+            entry,
+            mode=new_mode,
+            owner=target.owner or entry.owner,
+            group=target.group or entry.group,
+        )
+        if not recursive and new_mode == entry.mode and owner is None and group is None:
+            # the stat suffices to tell that nothing has to be changed
+            continue
+        cache.invalidate(host, target.path, recursive=recursive)
+
+        path = str(target.path)
+        if recursive:
+            batch_trees.append((len(batch), i))
+            batch.add(
+                _find_differing_cmd(target.path, mode, target.owner, target.group)
+            )
+            # one walk of the tree for both mode and ownership
+            requests.append(
+                (
+                    "permissions_tree",
+                    {
+                        "path": path,
+                        "mode": mode,
+                        "owner": target.owner,
+                        "group": target.group,
+                        "workers": agent.tree_workers if agent is not None else 1,
+                    },
+                )
+            )
+            request_targets.append(i)
+            continue
+        # chown may clear setuid and setgid bits, hence chmod afterwards
+        if owner is not None or group is not None:
+            requests.append(("chown", {"path": path, "owner": owner, "group": group}))
+            request_targets.append(i)
+            if owner is not None:
+                batch.add(["chown", owner + (f":{group}" if group else ""), path])
+            else:
+                batch.add(["chgrp", group, path])
+        if new_mode != entry.mode:
+            requests.append(("chmod", {"path": path, "mode": mode}))
+            request_targets.append(i)
+            batch.add(["chmod", mode, path])
+        changes[i] = 1
+    if agent is not None:
+        log_action(host, f"Applying {len(requests)} permission changes via agent")
+        results = agent.call_many(requests)
+        changes = [0] * len(targets)
+        for i, (op, args), result in zip(request_targets, requests, results):
+            changes[i] += result["changed"]
+            if op == "permissions_tree":
+                agent.log_tree_stats(args["path"], result)
+    elif len(batch):
+        batch.run()
+        for cmd_index, i in batch_trees:
+            # the differing entries, listed once for mode and once for ownership
+            changes[i] = len(set(batch.results[cmd_index].stdout.splitlines()))
+    return changes
+
+
+def _find_differing_cmd(
+    path: Path, mode: str | None, owner: str | None, group: str | None
+) -> list[str]:
+    """Return a command applying mode and ownership to the differing entries
+    of the tree, like permissions_tree of the agent.
+
+    The identifiers of the changed entries are printed. The mode test is exact
+    for modes that only add and remove permissions, like those of
+    filesystems.chmod_args, and symlinks are not followed.
+    """
+    steps = []
+    ownership_tests = []
+    if owner is not None:
+        ownership_tests += ["!", "-user", owner]
+    if group is not None:
+        if ownership_tests:
+            ownership_tests.append("-o")
+        ownership_tests += ["!", "-group", group]
+    if ownership_tests:
+        spec = f"{owner or ''}:{group}" if group is not None else str(owner)
+        steps.append((ownership_tests, ["chown", "-h", spec]))
+    if mode is not None:
+        # bits the mode adds and removes respectively
+        added = apply_symbolic_mode(0, mode, is_dir=False)
+        removed = 0o7777 & ~apply_symbolic_mode(0o7777, mode, is_dir=False)
+        mode_tests = []
+        if added:
+            mode_tests += ["!", "-perm", f"-{added:o}"]
+        if removed:
+            if mode_tests:
+                mode_tests.append("-o")
+            mode_tests += ["-perm", f"/{removed:o}"]
+        if mode_tests:
+            steps.append(
+                (["!", "-type", "l", "-a", "\\(", *mode_tests, "\\)"], ["chmod", mode])
+            )
+    # chown may clear setuid and setgid bits, hence chmod afterwards
+    cmds = [
+        " ".join(
+            [
+                "find",
+                shlex.quote(str(path)),
+                "\\(",
+                *tests,
+                "\\)",
+                "-printf",
+                "'%D:%i\\n'",
+                "-exec",
+                *cmd,
+                "{}",
+                "+",
+            ]
+        )
+        for tests, cmd in steps
+    ]
+    return [" && ".join(cmds) or "true"]
+
+
 class HostAgnosticPath:
     def __init__(
         self, path: str | Path, host: str = "localhost", sudo: bool = False
@@ -160,6 +1155,8 @@ class HostAgnosticPath:
     def read_text(self) -> str:
         if self.is_local_and_user():
             return self.path.read_text()
+        elif (agent := self._agent()) is not None:
+            return agent.call("read", path=str(self.path))
         else:
             return self._run_cmd(["cat", str(self.path)]).stdout
 
@@ -167,16 +1164,28 @@ class HostAgnosticPath:
         if self.is_local_and_user():
             self.path.write_text(content)
         else:
-            self._run_cmd(
-                ["tee", str(self.path)],
-                input=content,
-            )
+            self._invalidate_stat()
+            if (agent := self._agent()) is not None:
+                log_action(self.host, "Writing", self.path, "via agent")
+                agent.call("write", path=str(self.path), content=content)
+            else:
+                self._run_cmd(
+                    ["tee", str(self.path)],
+                    input=content,
+                )
 
     def mkdir(self) -> None:
         if self.is_local_and_user():
             self.path.mkdir(parents=True, exist_ok=True)
         else:
-            self._run_cmd(["mkdir", "-p", str(self.path)])
+            self._invalidate_stat()
+            for parent in self.parents:
+                parent._invalidate_stat()
+            if (agent := self._agent()) is not None:
+                log_action(self.host, "Creating directory", self.path, "via agent")
+                agent.call("mkdir", path=str(self.path))
+            else:
+                self._run_cmd(["mkdir", "-p", str(self.path)])
 
     def chmod(self, *mode: str, recursive: bool = True) -> None:
         self._chperm("chmod", ",".join(mode), recursive=recursive)
@@ -184,17 +1193,34 @@ class HostAgnosticPath:
     def chown(self, user: str | None, group: str | None = None) -> None:
         if user is not None:
             owner = f"{user}:{group}" if group else user
-            self._chperm("chown", owner)
+            self._chperm("chown", owner, owner=user, group=group)
         elif group is not None:
-            self._chperm("chgrp", group)
+            self._chperm("chgrp", group, owner=None, group=group)
         else:
             raise ValueError("Either user or group must be provided.")
 
-    def _chperm(self, cmd: str, arg: str, recursive: bool = True) -> None:
+    def _chperm(
+        self, cmd: str, arg: str, recursive: bool = True, **agent_args: Any
+    ) -> None:
         args = [arg]
-        if recursive and self.is_dir():
+        recursive = recursive and self.is_dir()
+        if recursive:
             args = ["-R", *args]
-        self._run_cmd([cmd, *args, str(self.path)])
+        self._invalidate_stat(recursive=recursive)
+        if (agent := self._agent()) is not None:
+            log_action(self.host, "Running", cmd, *args, self.path, "via agent")
+            if cmd == "chmod":
+                agent_args = {"mode": arg}
+            if recursive:
+                agent.permissions_tree(self.path, **agent_args)
+            else:
+                agent.call(
+                    "chmod" if cmd == "chmod" else "chown",
+                    path=str(self.path),
+                    **agent_args,
+                )
+        else:
+            self._run_cmd([cmd, *args, str(self.path)])
 
     def is_local_and_user(self) -> bool:
         return self.host == "localhost" and not self.sudo
@@ -208,33 +1234,36 @@ class HostAgnosticPath:
             host=self.host,
             sudo=self.sudo,
             user_error=user_error,
+            keep_stat_cache=True,
         )
 
-    def exists(self) -> bool:
+    def _agent(self) -> Agent | None:
         if self.is_local_and_user():
-            return self.path.exists()
-        else:
-            try:
-                self._run_cmd(
-                    ["test", "-e", str(self.path)],
-                    user_error=False,
-                )
-                return True
-            except sp.CalledProcessError:
-                return False
+            return None
+        return Agents.get_instance().get(self.host, self.sudo)
+
+    def _local_stat(self) -> PathStat | None:
+        try:
+            return PathStat.from_stat_result(self.path.stat())
+        except FileNotFoundError:
+            return None
+
+    def _invalidate_stat(self, recursive: bool = False) -> None:
+        if not self.is_local_and_user():
+            StatCache.get_instance().invalidate(
+                self.host, self.path, recursive=recursive
+            )
+
+    def stat(self) -> PathStat | None:
+        """Return metadata of the path or None if it does not exist."""
+        return stat_paths([self])[0]
+
+    def exists(self) -> bool:
+        return self.stat() is not None
 
     def is_dir(self) -> bool:
-        if self.is_local_and_user():
-            return self.path.is_dir()
-        else:
-            try:
-                self._run_cmd(
-                    ["test", "-d", str(self.path)],
-                    user_error=False,
-                )
-                return True
-            except sp.CalledProcessError:
-                return False
+        entry = self.stat()
+        return entry is not None and entry.is_dir
 
     def with_suffix(self, suffix: str) -> Self:
         return type(self)(self.path.with_suffix(suffix), host=self.host, sudo=self.sudo)
@@ -1,40 +1,253 @@
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
 import platform
 import re
-from typing import Any, Iterable, Self, Sequence
+import threading
+import time
+from types import MappingProxyType
+from typing import Any, Iterable, Iterator, Mapping, Self, Sequence
 import base64
+import copy
+import hashlib
+import json
+import os
+import pickle
+import shlex
+import tempfile
 
 import jinja2
+import jinja2.meta
 import yaml
 import git
 from pyfstab.entry import Entry as FstabEntry
 import yte
 
 from kisiac.common import (
+    ArchiveEntry,
     HostAgnosticPath,
+    PathStat,
     Singleton,
-    cache,
     UserError,
+    cache,
     check_type,
-    handle_key_error,
+    checksum_paths,
+    log_msg,
+    push_archive,
+    stat_paths,
 )
 from kisiac.lvm import LVMSetup
+from kisiac.runtime_settings import GlobalSettings
+
+try:
+    # use libyaml for parsing and dumping if available
+    from yaml import CDumper as Dumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import (
+        Dumper,  # type: ignore[assignment]
+        SafeLoader,  # type: ignore[assignment]
+    )
 
 
 config_file_path = Path("/etc/kisiac.yaml")
 
+# merged configs, which may contain secrets from the bootstrap config
+config_cache = cache / "config"
+# parsed and rendered YAML files, which may contain secrets as well
+yaml_cache = cache / "yaml"
+# entries of the YAML cache are removed if unused for longer than this or,
+# least recently used first, if the cache grows beyond the given size
+yaml_cache_max_age = 30 * 24 * 3600
+yaml_cache_max_size = 256 * 2**20
+
 
 required_marker = object()
 
 
-@dataclass
+def digest_json(value: Any) -> str:
+    """Return a digest of the given JSON-like value."""
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=repr).encode()
+    ).hexdigest()
+
+
+# config sections whose changes are tracked across deployments
+tracked_sections = [
+    "users",
+    "user_software",
+    "system_software",
+    "messages",
+    "infrastructure_name",
+    "lvm",
+    "filesystems",
+    "permissions",
+]
+
+
+def write_private(path: Path, data: bytes) -> None:
+    """Atomically write the file, readable only by the current user."""
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    # mkstemp creates the file with mode 0600
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class YamlCache(Singleton):
+    """Content addressed cache of parsed YAML and of YAML rendered with yte.
+
+    Entries are kept in memory and on disk, such that unchanged files are
+    neither parsed nor rendered again in later runs.
+    """
+
+    def __init__(self) -> None:
+        # pickled, such that each load returns a fresh object
+        self._parsed: dict[str, bytes] = {}
+        self._rendered: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.prune()
+
+    def prune(self) -> None:
+        """Remove entries that have not been used recently from the disk cache.
+
+        The modification time of an entry is its last use.
+        """
+        try:
+            entries = [(path, path.stat()) for path in yaml_cache.iterdir()]
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry[1].st_mtime, reverse=True)
+        now = time.time()
+        size = 0
+        for path, stat in entries:
+            size += stat.st_size
+            if now - stat.st_mtime > yaml_cache_max_age or size > yaml_cache_max_size:
+                path.unlink(missing_ok=True)
+
+    def _read(self, path: Path) -> bytes:
+        data = path.read_bytes()
+        # mark as recently used
+        os.utime(path)
+        return data
+
+    def load(self, content: bytes) -> Any:
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            data = self._parsed.get(digest)
+        if data is None:
+            path = yaml_cache / f"{digest}.pickle"
+            try:
+                data = self._read(path)
+                pickle.loads(data)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                data = pickle.dumps(yaml.load(content, Loader=SafeLoader))
+                write_private(path, data)
+            with self._lock:
+                self._parsed[digest] = data
+        return pickle.loads(data)
+
+    def render(
+        self, content: bytes, vars: Mapping[str, Any], used: dict[str, Any]
+    ) -> str:
+        """Render the YAML content with yte (if it uses yte) and dump it again.
+
+        Results are keyed by the content and the values of the used variables.
+        """
+        digest = hashlib.sha256(content + digest_json(used).encode()).hexdigest()
+        with self._lock:
+            rendered = self._rendered.get(digest)
+        if rendered is None:
+            path = yaml_cache / f"{digest}.yaml"
+            try:
+                rendered = self._read(path).decode()
+            except OSError:
+                rendered = self._render(content, vars)
+                write_private(path, rendered.encode())
+            with self._lock:
+                self._rendered[digest] = rendered
+        return rendered
+
+    def _render(self, content: bytes, vars: Mapping[str, Any]) -> str:
+        doc = self.load(content)
+        # same semantics as yte.process_yaml with require_use_yte
+        use_yte = doc.get("__use_yte__") if isinstance(doc, dict) else None
+        if use_yte:
+            doc = yte.process_yaml(
+                content.decode(), variables=dict(vars), require_use_yte=True
+            )
+        elif use_yte is not None:
+            doc.pop("__use_yte__")
+        assert doc is not None
+        return yaml.dump(doc, Dumper=Dumper, indent=2)
+
+
+@dataclass(frozen=True)
+class Changes:
+    """Changes of the config of a host since its last deployment."""
+
+    # changed files of the repo
+    paths: frozenset[Path]
+    # changed config sections (see tracked_sections)
+    sections: frozenset[str]
+    # changed global vars
+    vars: frozenset[str]
+    # changed vars of users that already existed at the last deployment
+    user_vars: Mapping[str, frozenset[str]]
+
+    @classmethod
+    def between(
+        cls, old: dict[str, Any], new: dict[str, Any], paths: Iterable[Path]
+    ) -> Self:
+        """Determine the changes between two fingerprints (see Config.fingerprints)."""
+
+        def changed(old: dict[str, str], new: dict[str, str]) -> frozenset[str]:
+            return frozenset(
+                key for key in old.keys() | new.keys() if old.get(key) != new.get(key)
+            )
+
+        return cls(
+            paths=frozenset(paths),
+            sections=changed(old["sections"], new["sections"]),
+            vars=changed(old["vars"], new["vars"]),
+            user_vars={
+                user: changed(old["users"][user], user_vars)
+                for user, user_vars in new["users"].items()
+                if user in old["users"]
+            },
+        )
+
+    def affects_file(
+        self,
+        dependencies: frozenset[Path] | None,
+        referenced: frozenset[str] | None,
+        user: str | None,
+    ) -> bool:
+        """Return whether a file has to be deployed again.
+
+        Dependencies are the repo files the file is rendered from, referenced
+        the variables it may refer to. None means unknown.
+        """
+        if dependencies is None or referenced is None:
+            return True
+        if dependencies & self.paths or referenced & self.vars:
+            return True
+        if user is None:
+            return False
+        if user not in self.user_vars:
+            # new user
+            return True
+        return bool(referenced & self.user_vars[user])
+
+
+@dataclass(frozen=True, slots=True)
 class Package:
     name: str
     cmd_spec: str | None
     desc: str
-    with_pkgs: list[str]
+    with_pkgs: tuple[str, ...]
     post_install: str | None
 
     @property
@@ -43,12 +256,64 @@ class Package:
 
     @property
     def install_cmd(self) -> str:
-        supplement = " ".join(f"--with {pkg}" for pkg in self.with_pkgs)
-
+        cmd = " ".join(
+            ["pixi global install", self.name]
+            + [f"--with {pkg}" for pkg in self.with_pkgs]
+        )
         if self.post_install:
-            supplement += " && ".join(self.post_install.splitlines())
+            cmd = " && ".join([cmd, *self.post_install.splitlines()])
+        return cmd
+
+
+# installed on every host in addition to the configured system_software
+default_system_software = [
+    "openssh-server",
+    "openssh-client",
+    "lvm2",
+    "e2fsprogs",
+    "xfsprogs",
+    "btrfs-progs",
+]
+
+pixi_install_cmd = "curl -fsSL https://pixi.sh/install.sh | sh"
+
+# Package cache shared by all users of a host. It resides on the same
+# filesystem as the home directories and is only written by a dedicated system
+# account, such that no user can modify the packages that other users run.
+pixi_cache_dir = Path("/home/.kisiac/pixi-cache")
+pixi_cache_owner = "kisiac-pixi"
+pixi_cache_owner_home = Path("/home/.kisiac/pixi-home")
+# Writable package cache of each user, relative to the home directory. It
+# overlays the shared cache: its pkgs directory links to the packages of the
+# shared cache, which pixi thereby only reads, while packages missing there
+# are unpacked into the private cache.
+user_pixi_cache = Path(".cache/rattler/cache")
+# Links the packages of the shared cache into the cache of the user, replacing
+# links to packages that have been removed from the shared cache.
+link_pixi_cache_cmd = (
+    f'mkdir -p "$HOME/{user_pixi_cache}/pkgs" && '
+    f'find "$HOME/{user_pixi_cache}/pkgs" -maxdepth 1 -xtype l -delete && '
+    f"( for pkg in {pixi_cache_dir}/pkgs/*/; do "
+    'pkg="${pkg%/}"; '
+    f'link="$HOME/{user_pixi_cache}/pkgs/${{pkg##*/}}"; '
+    '[ -d "$pkg" ] && ! [ -e "$link" ] || continue; '
+    'ln -sn "$pkg" "$link" || exit 1; '
+    "done )"
+)
+
+# stamp of the installed user software, relative to the home directory
+user_software_stamp = Path(".cache/kisiac/software")
 
-        return f"pixi global install {self.name} {supplement}"
+
+def software_fingerprint(packages: Sequence[Package]) -> str:
+    """Return the fingerprint of the user software, as stored in the stamps."""
+    return digest_json(
+        [
+            pixi_install_cmd,
+            link_pixi_cache_cmd,
+            *([pkg.cmd, pkg.install_cmd] for pkg in packages),
+        ]
+    )
 
 
 class FileType(Enum):
@@ -119,7 +384,7 @@ class UserSet(Enum):
     others = "others"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Permissions:
     owner: str | None
     group: str | None
@@ -131,26 +396,165 @@ class Permissions:
     sticky: bool
 
 
+@dataclass(frozen=True)
+class Ownership:
+    owner: str
+    group: str
+    file_mode: int
+    dir_mode: int
+
+
+system_ownership = Ownership(
+    owner="root", group="root", file_mode=0o644, dir_mode=0o755
+)
+
+
 @dataclass
 class File:
     target_path: Path
     content: str
 
-    def write(self, overwrite_existing: bool, host: str, sudo: bool) -> Sequence[Path]:
+    @property
+    def digest(self) -> str:
+        return hashlib.sha256(self.content.encode()).hexdigest()
+
+    def host_paths(self, host: str, sudo: bool) -> list[HostAgnosticPath]:
+        """Return the target path and its ancestors, e.g. for prefetching stats."""
         target_path = HostAgnosticPath(self.target_path, host=host, sudo=sudo)
-        if target_path.exists():
-            if target_path.read_text() == self.content:
-                return []
-            if not overwrite_existing:
+        return [target_path, *target_path.parents]
+
+
+def write_files(
+    files: Sequence[tuple[File, Ownership]], overwrite_existing: bool, host: str
+) -> Sequence[Path]:
+    """Deploy the given files to the host with a single archive transfer.
+
+    Missing ancestor directories are created with the given ownership.
+    Existing files keep their mode and owner. If overwrite_existing is False,
+    changed existing files are left untouched and the new content is placed
+    next to them with the suffix '.updated'. Returns the written files.
+    """
+    # fetch metadata of all targets and their ancestors in one go
+    paths = [path.path for file, _ in files for path in file.host_paths(host, True)]
+    stats = dict(
+        zip(paths, stat_paths([HostAgnosticPath(p, host, sudo=True) for p in paths]))
+    )
+    # compare contents via checksums of the existing targets, again in one go
+    existing = [file.target_path for file, _ in files if stats[file.target_path]]
+    digests = dict(
+        zip(
+            existing,
+            checksum_paths([HostAgnosticPath(p, host, sudo=True) for p in existing]),
+        )
+    )
+    entries, written = plan_files(files, overwrite_existing, stats, digests)
+    push_archive(entries, host=host, sudo=True)
+    return written
+
+
+def plan_files(
+    files: Sequence[tuple[File, Ownership]],
+    overwrite_existing: bool,
+    stats: dict[Path, PathStat | None],
+    digests: dict[Path, str | None],
+) -> tuple[list[ArchiveEntry], list[Path]]:
+    """Determine the archive entries for deploying the given files (see write_files).
+
+    Requires the stats of all target paths and their ancestors, as well as
+    the digests of all existing target paths.
+    """
+    entries: dict[Path, ArchiveEntry] = {}
+    written = []
+    # the last file for a given target wins, like the last layer of a host stack
+    latest = {file.target_path: (file, ownership) for file, ownership in files}
+    for file, ownership in latest.values():
+        target_path = file.target_path
+        mode, owner, group = ownership.file_mode, ownership.owner, ownership.group
+        current = stats[target_path]
+        if current is not None:
+            if digests.get(target_path) == file.digest:
+                continue
+            if overwrite_existing:
+                mode, owner, group = current.mode, current.owner, current.group
+            else:
                 target_path = target_path.with_suffix(".updated")
-        created = []
         for ancestor in target_path.parents[::-1][1:]:
-            if not ancestor.exists():
-                ancestor.mkdir()
-                created.append(ancestor.path)
-        target_path.write_text(self.content)
-        created.append(target_path.path)
-        return created
+            if ancestor not in entries and stats[ancestor] is None:
+                entries[ancestor] = ArchiveEntry(
+                    path=ancestor,
+                    content=None,
+                    mode=ownership.dir_mode,
+                    owner=ownership.owner,
+                    group=ownership.group,
+                )
+        entries[target_path] = ArchiveEntry(
+            path=target_path,
+            content=file.content,
+            mode=mode,
+            owner=owner,
+            group=group,
+        )
+        written.append(target_path)
+    return list(entries.values()), written
+
+
+def target_hostname(host: str) -> str:
+    """Return the name that is matched against the host patterns of the repo."""
+    return platform.node() if host == "localhost" else host
+
+
+class HostIndex:
+    """Index of the host directories of the infrastructure stack.
+
+    The names of the host directories are patterns, in which '*' matches any
+    non-empty sequence of characters. The directory 'all' matches every host.
+    """
+
+    def __init__(self, infrastructures: Iterable[Path]) -> None:
+        self.layers: list[tuple[Path, list[tuple[Path, re.Pattern[str] | None]]]] = []
+        for infra in infrastructures:
+            base = infra / "hosts"
+            patterns = []
+            if base.exists():
+                # 'all' first, such that more specific hosts may override it
+                entries = sorted(
+                    base.iterdir(), key=lambda e: (e.name != "all", e.name)
+                )
+                for entry in entries:
+                    if not entry.is_dir():
+                        raise UserError(f"{base} may only contain directories")
+                    regex = None
+                    if entry.name != "all":
+                        regex = re.compile(re.escape(entry.name).replace(r"\*", ".+"))
+                    patterns.append((entry, regex))
+            self.layers.append((infra, patterns))
+        self._stacks: dict[tuple[str, bool], list[Path]] = {}
+
+    def resolve(
+        self, hostname: str, include_infrastructure_root: bool = False
+    ) -> list[Path]:
+        key = (hostname, include_infrastructure_root)
+        if key in self._stacks:
+            return self._stacks[key]
+        stack = []
+        for infra, patterns in self.layers:
+            if include_infrastructure_root:
+                stack.append(infra)
+            stack.extend(
+                entry
+                for entry, regex in patterns
+                if regex is None or regex.fullmatch(hostname)
+            )
+        self._stacks[key] = stack
+        return stack
+
+    def resolve_many(
+        self, hostnames: Iterable[str], include_infrastructure_root: bool = False
+    ) -> dict[str, list[Path]]:
+        return {
+            hostname: self.resolve(hostname, include_infrastructure_root)
+            for hostname in hostnames
+        }
 
 
 class Files:
@@ -158,16 +562,109 @@ class Files:
         cache_address = base64.b64encode(config.repo.encode()).decode()
         self.repo_cache = cache / cache_address
         self.infrastructure = config.infrastructure
-        self.vars = config.vars
-        self.user_vars = config.user_vars
+        settings = GlobalSettings.get_instance()
         if not self.repo_cache.exists():
+            if settings.offline:
+                raise UserError(
+                    f"No cached copy of the config repo {config.repo} available, "
+                    "cannot run in offline mode."
+                )
             self.repo_cache.parent.mkdir(parents=True, exist_ok=True)
-            self.repo = git.Repo.clone_from(config.repo, self.repo_cache)
+            # Only the latest commit is needed, and only the parts of the
+            # repo that concern the configured infrastructure.
+            self.repo = git.Repo.clone_from(
+                config.repo,
+                self.repo_cache,
+                depth=1,
+                filter="blob:none",
+                sparse=True,
+            )
+            self._sparse_checkout()
+            self._fetch_stamp.touch()
         else:
             self.repo = git.Repo(self.repo_cache)
-            if self.repo.remotes:
-                # update to latest commit
-                self.repo.remotes.origin.pull()
+            self._sparse_checkout()
+            if (
+                self.repo.remotes
+                and not settings.offline
+                and time.time() - self._last_fetch() >= settings.fetch_ttl
+            ):
+                self._update_repo()
+
+        # Template environments are created once and reused for all hosts and
+        # users. Compiled templates are persisted across runs in the bytecode
+        # cache, which jinja validates against the checksum of the source.
+        bytecode_cache_dir = cache / "jinja"
+        bytecode_cache_dir.mkdir(parents=True, exist_ok=True)
+        self._bytecode_cache = jinja2.FileSystemBytecodeCache(str(bytecode_cache_dir))
+        self._templates: dict[Path | None, jinja2.Environment] = {}
+        self._templates_lock = threading.Lock()
+
+        # Rendered contents are memoized by the values of the variables
+        # that the respective file references, such that files are rendered
+        # only once for all users that share these values.
+        self._referenced_vars: dict[Path, frozenset[str] | None] = {}
+        self._template_refs: dict[Path, tuple[frozenset[str], list[Path] | None]] = {}
+        self._renders: dict[tuple[Path, str], str] = {}
+        self._renders_lock = threading.RLock()
+        self._kisiac_sh: dict[tuple[Path, ...], File] = {}
+        self._host_index: tuple[str, HostIndex] | None = None
+        self._stack_configs: dict[tuple[Path, ...], dict[str, Any]] = {}
+
+    @property
+    def _fetch_stamp(self) -> Path:
+        return Path(self.repo.git_dir) / "kisiac_fetched"
+
+    def _last_fetch(self) -> float:
+        try:
+            return self._fetch_stamp.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def _sparse_checkout(self) -> None:
+        # only sparse clones are restricted, not caches from earlier versions
+        sparse = self.repo.git.config(
+            "--get", "--bool", "core.sparseCheckout", with_exceptions=False
+        )
+        if sparse == "true":
+            dirs = ["infrastructure/all"]
+            if self.infrastructure is not None:
+                dirs.append(f"infrastructure/{self.infrastructure}")
+            self.repo.git.sparse_checkout("set", *dirs)
+
+    def _update_repo(self) -> None:
+        # update to latest commit
+        origin = self.repo.remotes.origin
+        if (Path(self.repo.git_dir) / "shallow").exists():
+            # The cache is never modified locally, hence it can be moved to
+            # the fetched commit instead of merging unrelated shallow histories.
+            tracking_branch = self.repo.active_branch.tracking_branch()
+            assert tracking_branch is not None
+            origin.fetch(depth=1)
+            self.repo.head.reset(tracking_branch.commit, index=True, working_tree=True)
+        else:
+            origin.pull()
+        self._fetch_stamp.touch()
+
+    def templates(self, base: Path | None = None) -> jinja2.Environment:
+        """Return the template environment for the given directory.
+
+        If base is None, the environment of the built-in templates is returned.
+        """
+        with self._templates_lock:
+            if base not in self._templates:
+                if base is None:
+                    loader: jinja2.BaseLoader = jinja2.PackageLoader("kisiac", "files")
+                else:
+                    loader = jinja2.FileSystemLoader(base)
+                self._templates[base] = jinja2.Environment(
+                    loader=loader,
+                    autoescape=jinja2.select_autoescape(),
+                    bytecode_cache=self._bytecode_cache,
+                )
+                if base is None:
+                    self._templates[base].filters["quote"] = shlex.quote
+            return self._templates[base]
 
     def infrastructure_stack(self) -> Iterable[Path]:
         base = self.repo_cache / "infrastructure"
@@ -179,91 +676,470 @@ class Files:
             if infra_path.exists():
                 yield infra_path
 
-    def host_stack(self, include_infrastructure_root: bool = False) -> Iterable[Path]:
-        hostname = platform.node()
-        for infra in self.infrastructure_stack():
-            base = infra / "hosts"
-            if include_infrastructure_root and infra.exists():
-                yield infra
-            if base.exists():
-                for entry in base.iterdir():
-                    if not entry.is_dir():
-                        raise UserError(f"{base} may only contain directories")
-                    # yield if all or entry matches hostname
-                    regex = str(entry).replace("*", r".+")
-                    if entry.name == "all" or re.match(regex, hostname):
-                        yield entry
+    def host_index(self) -> HostIndex:
+        """Return the index of the host directories, compiled once per commit."""
+        commit = self.repo.head.commit.hexsha
+        with self._renders_lock:
+            if self._host_index is None or self._host_index[0] != commit:
+                self._host_index = (commit, HostIndex(self.infrastructure_stack()))
+            return self._host_index[1]
+
+    def host_stack(
+        self, host: str, include_infrastructure_root: bool = False
+    ) -> list[Path]:
+        return self.host_index().resolve(
+            target_hostname(host), include_infrastructure_root
+        )
 
-    def get_config(self) -> dict[str, Any]:
+    def get_config(self, host: str) -> dict[str, Any]:
+        stack = tuple(self.host_stack(host, include_infrastructure_root=True))
+        with self._renders_lock:
+            if stack in self._stack_configs:
+                return self._stack_configs[stack]
         config = {}
-        for base in self.host_stack(include_infrastructure_root=True):
+        for base in stack:
             config_path = base / "kisiac.yaml"
             if config_path.exists():
-                with open(config_path, "r") as f:
-                    config.update(yaml.safe_load(f))
+                config.update(YamlCache.get_instance().load(config_path.read_bytes()))
+        with self._renders_lock:
+            self._stack_configs[stack] = config
         return config
 
-    def get_files(self, user: str | None) -> Iterable[File]:
+    def get_files(
+        self, user: str | None, host: str, changes: Changes | None = None
+    ) -> Iterable[File]:
+        """Render the system files (user None) or the files of the given user.
+
+        If changes are given, only files affected by them are rendered.
+        """
+        config = Config.get_instance().for_host(host).snapshot
         if user is not None:
             file_type = "user_files"
-            vars = dict(self.vars) | self.user_vars(user)
+            vars = {**config.vars, **config.user_vars(user)}
 
             # yield built-in user files
-            templates = jinja2.Environment(
-                loader=jinja2.PackageLoader("kisiac", "files"),
-                autoescape=jinja2.select_autoescape(),
-            )
-            content = templates.get_template("kisiac.sh.j2").render(
-                packages=Config.get_instance().user_software,
-                infrastructure_name=Config.get_instance().infrastructure_name,
-                infrastructure_name_len=len(Config.get_instance().infrastructure_name),
-                messages=Config.get_instance().messages,
-            )
-            yield File(target_path=Path("/etc/profile.d/kisiac.sh"), content=content)
+            if changes is None or changes.sections & {
+                "user_software",
+                "infrastructure_name",
+                "messages",
+                "builtin_templates",
+            }:
+                yield self.kisiac_sh(host)
         else:
             file_type = "system_files"
-            vars = self.vars
-
-        for host in self.host_stack():
-            collection = host / file_type
-            templates = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(host),
-                autoescape=jinja2.select_autoescape(),
-            )
-            for base, _, files in (collection).walk():
+            vars = config.vars
+
+        # files of later host directories in the stack override earlier ones
+        stack = self.host_stack(host)
+        sources: dict[Path, tuple[Path, Path]] = {}
+        for host_dir in stack:
+            collection = host_dir / file_type
+            # os.walk instead of Path.walk, which requires Python 3.12
+            for base, _, files in os.walk(collection):
                 for f in files:
-                    if f.endswith(".j2"):
-                        content = templates.get_template(str(base / f)).render(**vars)
-                    elif f.endswith(".yaml"):
-                        with open(base / f, "r") as fileobj:
-                            content = yte.process_yaml(
-                                fileobj, variables=vars, require_use_yte=True
-                            )
-                        assert content is not None
-                        content = yaml.dump(content, indent=2)
-                    else:
-                        with open(base / f, "r") as content:
-                            content = content.read()
-                    yield File((base / f).relative_to(collection), content)
+                    path = Path(base) / f
+                    sources[path.relative_to(collection)] = (host_dir, path)
+
+        for target_path, (host_dir, path) in sources.items():
+            # a changed file for the target in any layer, e.g. a removed
+            # override, may change which layer provides it
+            layers = {layer / file_type / target_path for layer in stack}
+            if (
+                changes is not None
+                and not layers & changes.paths
+                and not changes.affects_file(
+                    self.dependencies(host_dir, path),
+                    self.referenced_vars(host_dir, path),
+                    user,
+                )
+            ):
+                continue
+            content = self.render(host_dir, path, vars)
+            yield File(target_path, content)
+
+    def changed_paths(self, commit: str) -> set[Path] | None:
+        """Return the files of the repo that changed since the given commit.
+
+        Returns None if the commit is not available.
+        """
+        if not self._has_commit(commit):
+            if GlobalSettings.get_instance().offline or not self.repo.remotes:
+                return None
+            # shallow clones lack earlier commits, only the tree is needed
+            try:
+                self.repo.remotes.origin.fetch(commit, depth=1)
+            except git.GitCommandError:
+                return None
+        diff = self.repo.git.diff("--name-only", "--no-renames", commit, "HEAD")
+        return {self.repo_cache / path for path in diff.splitlines()}
+
+    def _has_commit(self, commit: str) -> bool:
+        # repo.commit() accepts any full hex sha without looking it up
+        try:
+            self.repo.git.cat_file("-e", f"{commit}^{{commit}}")
+        except git.GitCommandError:
+            return False
+        return True
+
+    def builtin_templates_digest(self) -> str:
+        templates = self.templates()
+        assert templates.loader is not None
+        source, _, _ = templates.loader.get_source(templates, "kisiac.sh.j2")
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def kisiac_sh(self, host: str) -> File:
+        # does not depend on any user, hence rendered only once per host stack
+        stack = tuple(self.host_stack(host, include_infrastructure_root=True))
+        with self._renders_lock:
+            if stack not in self._kisiac_sh:
+                config = Config.get_instance().for_host(host).snapshot
+                content = (
+                    self.templates()
+                    .get_template("kisiac.sh.j2")
+                    .render(
+                        packages=config.user_software,
+                        pixi_install_cmd=pixi_install_cmd,
+                        pixi_cache=user_pixi_cache,
+                        link_pixi_cache_cmd=link_pixi_cache_cmd,
+                        software_stamp=user_software_stamp,
+                        software_fingerprint=software_fingerprint(config.user_software),
+                        infrastructure_name=config.infrastructure_name,
+                        infrastructure_name_len=len(config.infrastructure_name),
+                        messages=config.messages,
+                    )
+                )
+                self._kisiac_sh[stack] = File(
+                    target_path=Path("/etc/profile.d/kisiac.sh"), content=content
+                )
+            return self._kisiac_sh[stack]
 
+    def render(self, host: Path, path: Path, vars: dict[str, Any]) -> str:
+        """Render the given file, reusing earlier renders with equal inputs."""
+        referenced = self.referenced_vars(host, path)
+        if referenced is None:
+            used = vars
+        else:
+            used = {name: vars[name] for name in sorted(referenced) if name in vars}
+        key = (path, digest_json(used))
+        with self._renders_lock:
+            content = self._renders.get(key)
+        if content is None:
+            content = self._render(host, path, vars, used)
+            with self._renders_lock:
+                self._renders[key] = content
+        return content
+
+    def referenced_vars(self, host: Path, path: Path) -> frozenset[str] | None:
+        """Return the names of the variables the given file may refer to.
+
+        Templates that are included, imported or extended are taken into
+        account. Returns None if the file may refer to any variable.
+        """
+        with self._renders_lock:
+            if path in self._referenced_vars:
+                return self._referenced_vars[path]
+        referenced: frozenset[str] | None
+        if path.suffix == ".j2":
+            closure = self.template_closure(host, path)
+            if closure is None:
+                referenced = None
+            else:
+                referenced = frozenset().union(
+                    *(self._template_refs_of(host, dep)[0] for dep in closure)
+                )
+        elif path.suffix == ".yaml":
+            # yte evaluates arbitrary python expressions, hence take any
+            # identifier into account (a conservative superset)
+            referenced = frozenset(re.findall(r"[A-Za-z_]\w*", path.read_text()))
+        else:
+            referenced = frozenset()
+        with self._renders_lock:
+            self._referenced_vars[path] = referenced
+        return referenced
+
+    def dependencies(self, host: Path, path: Path) -> frozenset[Path] | None:
+        """Return the repo files the given file is rendered from.
+
+        Returns None if they cannot be determined statically.
+        """
+        if path.suffix == ".j2":
+            return self.template_closure(host, path)
+        return frozenset([path])
+
+    def template_closure(self, host: Path, path: Path) -> frozenset[Path] | None:
+        """Return the template and all templates it depends on, transitively.
+
+        Returns None if a reference cannot be resolved statically.
+        """
+        closure: set[Path] = set()
+        pending = [path]
+        while pending:
+            current = pending.pop()
+            if current in closure:
+                continue
+            if not current.is_file():
+                return None
+            closure.add(current)
+            references = self._template_refs_of(host, current)[1]
+            if references is None:
+                return None
+            pending.extend(references)
+        return frozenset(closure)
+
+    def _template_refs_of(
+        self, host: Path, path: Path
+    ) -> tuple[frozenset[str], list[Path] | None]:
+        # undeclared variables and directly referenced templates (None if any
+        # of them is determined at render time) of the template
+        with self._renders_lock:
+            if path in self._template_refs:
+                return self._template_refs[path]
+        ast = self.templates(host).parse(path.read_text())
+        names = list(jinja2.meta.find_referenced_templates(ast))
+        refs = (
+            frozenset(jinja2.meta.find_undeclared_variables(ast)),
+            None if None in names else [host / name for name in names],
+        )
+        with self._renders_lock:
+            self._template_refs[path] = refs
+        return refs
+
+    def _render(
+        self, host: Path, path: Path, vars: dict[str, Any], used: dict[str, Any]
+    ) -> str:
+        if path.suffix == ".j2":
+            # template names are relative to the loader's directory
+            name = path.relative_to(host).as_posix()
+            return self.templates(host).get_template(name).render(**vars)
+        elif path.suffix == ".yaml":
+            return YamlCache.get_instance().render(path.read_bytes(), vars, used)
+        else:
+            with open(path, "r") as fileobj:
+                return fileobj.read()
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class User:
     username: str
     primary_group: str
-    secondary_groups: list[str]
+    secondary_groups: tuple[str, ...]
     ssh_pub_key: str
-    vars: dict[str, Any]
-
-    def fix_permissions(self, paths: Iterable[Path], host: str) -> None:
-        for path in paths:
-            path = HostAgnosticPath(path, host=host, sudo=True)
-            # ensure that only user may read/write the paths
-            if path.is_dir():
-                path.chmod("u=rwx", "g-rwx", "o-rwx")
-            else:
-                path.chmod("u=rw", "g-rwx", "o-rwx")
-            path.chown(self.username, self.primary_group)
+    vars: Mapping[str, Any]
+
+    @property
+    def ownership(self) -> Ownership:
+        # ensure that only user may read/write the paths
+        return Ownership(
+            owner=self.username,
+            group=self.primary_group,
+            file_mode=0o600,
+            dir_mode=0o700,
+        )
+
+
+@contextmanager
+def _collect_errors(errors: list[str], item: str) -> Iterator[None]:
+    # record the error and continue, such that all errors can be reported at once
+    try:
+        yield
+    except UserError as e:
+        errors.append(f"{item}: {e}")
+    except KeyError as e:
+        errors.append(f"{item}: missing key {e}")
+    except (TypeError, ValueError) as e:
+        errors.append(f"{item}: {e}")
+
+
+def _get(config: dict[str, Any], key: str, default: Any = required_marker) -> Any:
+    value = config.get(key, default)
+    if value is required_marker:
+        raise UserError(f"Config lacks key {key}.")
+    return value
+
+
+def _parse_users(config: dict[str, Any], errors: list[str]) -> tuple[User, ...]:
+    users = []
+    with _collect_errors(errors, "users"):
+        entries = _get(config, "users")
+        check_type("users key", entries, dict)
+        for username, settings in entries.items():
+            with _collect_errors(errors, f"user {username}"):
+                check_type(f"user {username}", settings, dict)
+                primary_group = settings["groups"]["primary"]
+                secondary_groups = settings["groups"].get("secondary", [])
+                check_type(f"user {username} groups", secondary_groups, list)
+                vars = settings.get("vars", {})
+                check_type(f"user {username} vars", vars, dict)
+                users.append(
+                    User(
+                        username,
+                        ssh_pub_key=settings["ssh_pub_key"],
+                        vars=MappingProxyType(vars),
+                        primary_group=primary_group,
+                        secondary_groups=tuple(map(str, secondary_groups)),
+                    )
+                )
+    return tuple(users)
+
+
+def _parse_user_software(
+    config: dict[str, Any], errors: list[str]
+) -> tuple[Package, ...]:
+    packages = []
+    with _collect_errors(errors, "user_software"):
+        entries = _get(config, "user_software")
+        check_type("user_software key", entries, list)
+        for entry in entries:
+            with _collect_errors(errors, f"user_software entry {entry}"):
+                check_type("user_software entry", entry, dict)
+                with_pkgs = entry.get("with", [])
+                # a single package may be given as plain string
+                if isinstance(with_pkgs, str):
+                    with_pkgs = [with_pkgs]
+                check_type(f"user_software {entry['pkg']} with", with_pkgs, list)
+                packages.append(
+                    Package(
+                        name=entry["pkg"],
+                        cmd_spec=entry.get("cmd"),
+                        desc=entry["desc"],
+                        with_pkgs=tuple(map(str, with_pkgs)),
+                        post_install=entry.get("post_install"),
+                    )
+                )
+    return tuple(packages)
+
+
+def _parse_str_list(
+    config: dict[str, Any], key: str, errors: list[str]
+) -> tuple[str, ...]:
+    with _collect_errors(errors, key):
+        value = _get(config, key, [])
+        check_type(f"{key} key", value, list)
+        return tuple(map(str, value))
+    return ()
+
+
+def _parse_filesystems(
+    config: dict[str, Any], errors: list[str]
+) -> tuple[Filesystem, ...]:
+    filesystems = []
+    with _collect_errors(errors, "filesystems"):
+        entries = _get(config, "filesystems", [])
+        check_type("filesystems key", entries, list)
+        for settings in entries:
+            with _collect_errors(errors, f"filesystem {settings}"):
+                check_type("filesystem item", settings, dict)
+                device = settings.get("device")
+                filesystems.append(
+                    Filesystem(
+                        device=Path(device) if device is not None else None,
+                        label=settings.get("label"),
+                        uuid=settings.get("uuid"),
+                        fstype=settings["type"],
+                        mountpoint=Path(settings["mount"]),
+                        options=settings.get("options", "defaults"),
+                        dump=settings.get("dump", 0),
+                        fsck=settings.get("pass", 0),
+                    )
+                )
+    return tuple(filesystems)
+
+
+def _parse_permissions(
+    config: dict[str, Any], errors: list[str]
+) -> Mapping[Path, Permissions]:
+    permissions = {}
+    with _collect_errors(errors, "permissions"):
+        entries = _get(config, "permissions", {})
+        check_type("permissions key", entries, dict)
+        for path_str, settings in entries.items():
+            with _collect_errors(errors, f"permissions for {path_str}"):
+                check_type(f"permissions for {path_str}", settings, dict)
+
+                def user_set(
+                    key: str, settings: dict[str, Any] = settings
+                ) -> UserSet | None:
+                    return UserSet(settings[key]) if key in settings else None
+
+                permissions[Path(path_str)] = Permissions(
+                    owner=settings.get("owner"),
+                    group=settings.get("group"),
+                    read=user_set("read"),
+                    write=user_set("write"),
+                    execute=user_set("execute"),
+                    setgid=settings.get("setgid", False),
+                    setuid=settings.get("setuid", False),
+                    sticky=settings.get("sticky", False),
+                )
+    return MappingProxyType(permissions)
+
+
+@dataclass(frozen=True, slots=True)
+class ConfigSnapshot:
+    """Validated, immutable view on the config of a host.
+
+    It is created once per host and shared by all phases and workers.
+    """
+
+    users: tuple[User, ...]
+    vars: Mapping[str, Any]
+    user_software: tuple[Package, ...]
+    system_software: tuple[str, ...]
+    messages: tuple[str, ...]
+    infrastructure_name: str
+    lvm: LVMSetup
+    filesystems: tuple[Filesystem, ...]
+    permissions: Mapping[Path, Permissions]
+    _users_by_name: Mapping[str, User] = field(repr=False, compare=False)
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> Self:
+        """Validate the given config, reporting all errors at once."""
+        errors: list[str] = []
+        users = _parse_users(config, errors)
+
+        # values are only taken once their type is valid, such that the
+        # snapshot can be created despite errors and all of them are reported
+        vars: dict[str, Any] = {}
+        with _collect_errors(errors, "vars"):
+            value = _get(config, "vars", {})
+            check_type("vars key", value, dict)
+            vars = value
+
+        infrastructure_name = ""
+        with _collect_errors(errors, "infrastructure_name"):
+            value = _get(config, "infrastructure_name")
+            check_type("infrastructure_name key", value, str)
+            infrastructure_name = value
+
+        lvm = LVMSetup()
+        with _collect_errors(errors, "lvm"):
+            lvm = LVMSetup.from_config(_get(config, "lvm", {}))
+
+        snapshot = cls(
+            users=users,
+            vars=MappingProxyType(vars),
+            user_software=_parse_user_software(config, errors),
+            system_software=_parse_str_list(config, "system_software", errors),
+            messages=_parse_str_list(config, "messages", errors),
+            infrastructure_name=infrastructure_name,
+            lvm=lvm,
+            filesystems=_parse_filesystems(config, errors),
+            permissions=_parse_permissions(config, errors),
+            _users_by_name=MappingProxyType({user.username: user for user in users}),
+        )
+        if errors:
+            raise UserError(
+                "Invalid configuration:\n" + "\n".join(f"* {e}" for e in errors)
+            )
+        return snapshot
+
+    def user_vars(self, username: str) -> Mapping[str, Any]:
+        return self._users_by_name[username].vars
+
+    def system_packages(self) -> list[str]:
+        """Return the configured system software plus the default packages."""
+        return sorted(set(self.system_software).union(default_system_software))
 
 
 class Config(Singleton):
@@ -277,7 +1153,7 @@ class Config(Singleton):
         self._config: dict[str, Any] = {}
 
         def update_config(config) -> None:
-            config = yaml.safe_load(config)
+            config = YamlCache.get_instance().load(config)
 
             if not isinstance(config, dict):
                 raise ValueError("Config has to be a mapping")
@@ -286,8 +1162,9 @@ class Config(Singleton):
         config_set = False
 
         try:
-            with open(config_file_path, "r") as f:
-                update_config(f)
+            with open(config_file_path, "rb") as f:
+                bootstrap = f.read()
+            update_config(bootstrap)
             config_set = True
         except (FileNotFoundError, IOError):
             # ignore missing file or read errors, we fall back to env var
@@ -304,11 +1181,81 @@ class Config(Singleton):
             )
 
         self._files: Files | None = None
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self._bootstrap = dict(self._config)
+        self._bootstrap_digest = hashlib.sha256(bootstrap).hexdigest()
+        self._host_configs: dict[str, Self] = {}
+        self._host_configs_lock = threading.Lock()
+        self._snapshot: ConfigSnapshot | None = None
+
+        # the controller host
+        hostname = platform.node()
+        self._config.update(self.repo_config(hostname))
+        self._host_configs[hostname] = self
+
+    def for_host(self, host: str) -> Self:
+        """Return the config for the given target host."""
+        hostname = target_hostname(host)
+        with self._host_configs_lock:
+            if hostname not in self._host_configs:
+                host_config = copy.copy(self)
+                host_config._config = self._bootstrap | self.repo_config(hostname)
+                host_config._snapshot = None
+                self._host_configs[hostname] = host_config
+            return self._host_configs[hostname]
+
+    def for_hosts(self, hosts: Sequence[str]) -> dict[str, Self]:
+        """Resolve the configs of all given target hosts at once."""
+        # one pass over the host index, the results are memoized there
+        self.files.host_index().resolve_many(
+            map(target_hostname, hosts), include_infrastructure_root=True
+        )
+        configs = {host: self.for_host(host) for host in hosts}
+        log_msg(
+            f"Config cache: {self.cache_stats['hits']} hits, "
+            f"{self.cache_stats['misses']} misses"
+        )
+        # validate up front, reporting the errors of all hosts together
+        errors = []
+        for host, config in configs.items():
+            try:
+                config.validate()
+            except UserError as e:
+                errors.append(f"{host}: {e}")
+        if errors:
+            raise UserError("\n".join(errors))
+        return configs
+
+    def repo_config(self, host: str) -> dict[str, Any]:
+        """Return the merged config of the repo for the given host.
+
+        The result is cached on disk per host, keyed by the checked out commit
+        of the repo and the digest of the bootstrap config.
+        """
+        commit = self.files.repo.head.commit.hexsha
+        key = hashlib.sha256(f"{commit}:{self._bootstrap_digest}:{host}".encode())
+        # one directory per host, such that outdated entries of exactly this
+        # host can be removed below
+        host_cache = config_cache / host
+        path = host_cache / f"{key.hexdigest()}.pickle"
+        try:
+            with open(path, "rb") as f:
+                config = pickle.load(f)
+            self.cache_stats["hits"] += 1
+            return config
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # missing or corrupt, hence recreate
+            pass
+        self.cache_stats["misses"] += 1
+        config = self.files.get_config(host)
 
-        self._config.update(self.files.get_config())
+        for outdated in host_cache.glob("*.pickle"):
+            outdated.unlink(missing_ok=True)
+        write_private(path, pickle.dumps(config))
+        return config
 
     def as_str(self) -> str:
-        return yaml.dump(self._config)
+        return yaml.dump(self._config, Dumper=Dumper)
 
     def get(self, key: str, default: Any | None = required_marker) -> Any:
         value = self._config.get(key, default)
@@ -318,33 +1265,44 @@ class Config(Singleton):
 
         return value
 
-    @property
-    @handle_key_error("Invalid user configuration")
-    def users(self) -> Iterable[User]:
-        users = self.get("users")
-        check_type("users key", users, dict)
-
-        for username, settings in users.items():
-            check_type(f"user {username}", settings, dict)
-            primary_group = settings["groups"]["primary"]
-            secondary_groups = settings["groups"].get("secondary", [])
-            check_type(f"user {username} groups", secondary_groups, list)
-            yield User(
-                username,
-                ssh_pub_key=settings["ssh_pub_key"],
-                vars=settings.get("vars", {}),
-                primary_group=primary_group,
-                secondary_groups=list(map(str, secondary_groups)),
-            )
+    def fingerprints(self) -> dict[str, Any]:
+        """Return digests of the config sections, vars and user vars.
+
+        They are recorded with each deployment, in order to determine the
+        changes for the next one (see Changes).
+        """
+        users = self.get("users", default={})
+        return {
+            "sections": {
+                **{key: self.section_digest(key) for key in tracked_sections},
+                "builtin_templates": self.files.builtin_templates_digest(),
+            },
+            "vars": {
+                key: digest_json(value)
+                for key, value in self.get("vars", default={}).items()
+            },
+            "users": {
+                user: {
+                    key: digest_json(value)
+                    for key, value in settings.get("vars", {}).items()
+                }
+                for user, settings in users.items()
+            },
+        }
+
+    def section_digest(self, section: str) -> str:
+        return digest_json(self.get(section, None))
 
     @property
-    def vars(self) -> dict[str, Any]:
-        vars = self.get("vars", default={})
-        check_type("vars key", vars, dict)
-        return vars
+    def snapshot(self) -> ConfigSnapshot:
+        """The validated config of the host."""
+        return self.validate()
 
-    def user_vars(self, user: str) -> dict[str, Any]:
-        return self.get("users", default={})[user].get("vars", {})
+    def validate(self) -> ConfigSnapshot:
+        """Validate the config once, raising a UserError with all problems."""
+        if self._snapshot is None:
+            self._snapshot = ConfigSnapshot.from_config(self._config)
+        return self._snapshot
 
     @property
     def infrastructure(self) -> str:
@@ -364,80 +1322,3 @@ class Config(Singleton):
             self._files = Files(self)
 
         return self._files
-
-    @property
-    def user_software(self) -> Iterable[Package]:
-        user_software = self.get("user_software")
-        check_type("user_software key", user_software, list)
-        for entry in user_software:
-            check_type("user_software entry", entry, dict)
-            try:
-                yield Package(
-                    name=entry["pkg"],
-                    cmd_spec=entry.get("cmd"),
-                    desc=entry["desc"],
-                    with_pkgs=entry.get("with", []),
-                    post_install=entry.get("post_install"),
-                )
-            except KeyError as e:
-                raise UserError(f"Missing {e} in user_software definition.")
-
-    @property
-    def system_software(self) -> list[str]:
-        system_software = self.get("system_software", default=[])
-        check_type("system_software key", system_software, list)
-        return system_software
-
-    @property
-    def messages(self) -> Sequence[str]:
-        messages = self.get("messages", default=[])
-        check_type("message key", messages, list)
-        return messages
-
-    @property
-    def infrastructure_name(self) -> str:
-        infrastructure_name = self.get("infrastructure_name")
-        check_type("infrastructure_name key", infrastructure_name, str)
-        return infrastructure_name
-
-    @property
-    def lvm(self) -> LVMSetup:
-        lvm = self.get("lvm", default={})
-        return LVMSetup.from_config(lvm)
-
-    @property
-    def filesystems(self) -> Iterable[Filesystem]:
-        filesystems = self.get("filesystems", default={})
-        check_type("filesystems key", filesystems, list)
-        for settings in filesystems:
-            check_type("filesystem item", settings, dict)
-            device = settings.get("device")
-            yield Filesystem(
-                device=Path(device) if device is not None else None,
-                label=settings.get("label"),
-                uuid=settings.get("uuid"),
-                fstype=settings["type"],
-                mountpoint=settings["mount"],
-                options=settings.get("options", "defaults"),
-                dump=settings.get("dump", 0),
-                fsck=settings.get("pass", 0),
-            )
-
-    @property
-    def permissions(self) -> dict[Path, Permissions]:
-        check_type("permissions key", self._config.get("permissions", {}), dict)
-        permissions = {}
-        for path_str, settings in self._config.get("permissions", {}).items():
-            check_type(f"permissions for {path_str}", settings, dict)
-            path = Path(path_str)
-            permissions[path] = Permissions(
-                owner=settings.get("owner"),
-                group=settings.get("group"),
-                read=UserSet(settings["read"]) if "read" in settings else None,
-                write=UserSet(settings["write"]) if "write" in settings else None,
-                execute=UserSet(settings["execute"]) if "execute" in settings else None,
-                setgid=settings.get("setgid", False),
-                setuid=settings.get("setuid", False),
-                sticky=settings.get("sticky", False),
-            )
-        return permissions
@@ -4,8 +4,18 @@ import json
 from pathlib import Path
 import re
 from typing import Any, Self
-from kisiac.common import HostAgnosticPath, UserError, confirm_action, run_cmd
-from kisiac.config import Config, Filesystem, UserSet
+from kisiac.common import (
+    HostAgnosticPath,
+    PermissionTarget,
+    UserError,
+    apply_permissions,
+    confirm_action,
+    log_action,
+    run_cmd,
+    stat_paths,
+)
+from kisiac.config import Config, Filesystem, Permissions, UserSet
+from kisiac.state import StateStore
 
 from pyfstab import Fstab
 
@@ -13,7 +23,11 @@ blkid_attrs_re = re.compile(r'(?P<attr>[A-Z]+)="(?P<value>\S+)"')
 
 
 def update_filesystems(host: str) -> None:
-    filesystems = set(Config.get_instance().filesystems)
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "update_filesystems")
+    if journal.skip_phase(host, "update_filesystems", fingerprint):
+        return
+    filesystems = set(Config.get_instance().for_host(host).snapshot.filesystems)
     device_infos = DeviceInfos(host)
 
     # First, create filesystems that do not exist yet or need to be changed.
@@ -47,48 +61,112 @@ def update_filesystems(host: str) -> None:
             filesystem.to_fstab_entry() for filesystem in sorted(filesystems)
         ]
         fstab_path.write_text(new_fstab.write_string())
+        journal.record_phase(
+            host,
+            "update_filesystems",
+            fingerprint,
+            f"{len(mkfs_cmds)} filesystems created",
+        )
+
+
+def apply_user_set(user_set: UserSet | None, flag: str) -> list[str]:
+    if user_set is None:
+        return []
+    if user_set == UserSet.owner:
+        return [f"u+{flag}", f"g-{flag}", f"o-{flag}"]
+    elif user_set == UserSet.group:
+        return [f"u+{flag}", f"g+{flag}", f"o-{flag}"]
+    elif user_set == UserSet.others:
+        return [f"u+{flag}", f"g+{flag}", f"o+{flag}"]
+    elif user_set == UserSet.nobody:
+        return [f"u-{flag}", f"g-{flag}", f"o-{flag}"]
+    else:
+        assert False, "unreachable"
+
+
+def chmod_args(permissions: Permissions, is_dir: bool) -> tuple[list[str], list[str]]:
+    """Return the chmod arguments for the configured path.
+
+    The first list applies recursively, the second one only to the configured
+    path itself.
+    """
+    args = []
+    if permissions.setgid:
+        args.append("g+s")
+    if permissions.setuid:
+        args.append("u+s")
+    if permissions.sticky:
+        args.append("+t")
+    args.extend(apply_user_set(permissions.read, "r"))
+    args.extend(apply_user_set(permissions.write, "w"))
+
+    # execute permissions are handled differently for dir and files
+    if is_dir:
+        # With dirs, read should be considered equivalent to execute, and handled
+        # non-recursively. In turn, we ignore the execute setting for dirs because
+        # it becomes redundant.
+        return args, apply_user_set(permissions.read, "x")
+    else:
+        return args + apply_user_set(permissions.execute, "x"), []
 
 
 def update_permissions(host: str) -> None:
-    def apply_user_set(user_set: UserSet | None, flag: str) -> list[str]:
-        if user_set is None:
-            return []
-        if user_set == UserSet.owner:
-            return [f"u+{flag}", f"g-{flag}", f"o-{flag}"]
-        elif user_set == UserSet.group:
-            return [f"u+{flag}", f"g+{flag}", f"o-{flag}"]
-        elif user_set == UserSet.others:
-            return [f"u+{flag}", f"g+{flag}", f"o+{flag}"]
-        elif user_set == UserSet.nobody:
-            return [f"u-{flag}", f"g-{flag}", f"o-{flag}"]
-        else:
-            assert False, "unreachable"
-
-    permissions = Config.get_instance().permissions
-    for path, permissions in permissions.items():
-        path = HostAgnosticPath(path, host=host, sudo=True)
-        chmod_args = []
-        if permissions.setgid:
-            chmod_args.append("g+s")
-        if permissions.setuid:
-            chmod_args.append("u+s")
-        if permissions.sticky:
-            chmod_args.append("+t")
-        chmod_args.extend(apply_user_set(permissions.read, "r"))
-        chmod_args.extend(apply_user_set(permissions.write, "w"))
-        if chmod_args:
-            path.chmod(*chmod_args)
-
-        # execute permissions are handled differently for dir and files
-        if path.is_dir():
-            if permissions.read is not None:
-                # With dirs, read should be considered equivalent to execute, and handled
-                # non-recursively. In turn, we ignore the execute setting for dirs because
-                # it becomes redundant.
-                path.chmod(*apply_user_set(permissions.read, "x"), recursive=False)
-        elif permissions.execute is not None:
-            path.chmod(*apply_user_set(permissions.execute, "x"))
-        path.chown(permissions.owner, permissions.group)
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "update_permissions")
+    if journal.skip_phase(host, "update_permissions", fingerprint):
+        return
+    permissions = Config.get_instance().for_host(host).snapshot.permissions
+    paths = [HostAgnosticPath(path, host=host, sudo=True) for path in permissions]
+    targets = []
+    # index of the configured path of each target
+    target_paths = []
+    for i, (path, stat, settings) in enumerate(
+        zip(paths, stat_paths(paths), permissions.values())
+    ):
+        if stat is None:
+            raise UserError(f"Path {path} with configured permissions does not exist")
+        if settings.owner is None and settings.group is None:
+            raise UserError(f"Permissions for {path} lack owner or group")
+        recursive_args, args = chmod_args(settings, stat.is_dir)
+        recursive_mode = ",".join(recursive_args) or None
+        # The whole tree is checked, since the state of the contents cannot be
+        # inferred from the root. Only differing entries are changed.
+        targets.append(
+            PermissionTarget(
+                path.path,
+                file_mode=recursive_mode,
+                dir_mode=recursive_mode,
+                owner=settings.owner,
+                group=settings.group,
+            )
+        )
+        target_paths.append(i)
+        if args:
+            targets.append(
+                PermissionTarget(
+                    path.path,
+                    file_mode=",".join(args),
+                    dir_mode=",".join(args),
+                    owner=None,
+                    group=None,
+                    recursive=False,
+                )
+            )
+            target_paths.append(i)
+    changes = apply_permissions(targets, host=host)
+    changed_paths = {i for i, count in zip(target_paths, changes) if count}
+    compliant = len(permissions) - len(changed_paths)
+    log_action(
+        host,
+        f"{compliant} of {len(permissions)} configured paths already had the "
+        "desired permissions",
+    )
+    journal.record_phase(
+        host,
+        "update_permissions",
+        fingerprint,
+        f"{compliant} of {len(permissions)} paths compliant",
+    )
 
 
 @dataclass
@@ -3,9 +3,9 @@ import json
 from pathlib import Path
 from typing import Any, Self
 
-from humanfriendly import parse_size
+from humanfriendly import InvalidSize, parse_size
 
-from kisiac.common import check_type, exists_cmd, run_cmd
+from kisiac.common import UserError, check_type, exists_cmd, run_cmd
 
 
 @dataclass(frozen=True)
@@ -61,10 +61,14 @@ class LVMSetup:
             lvs_entities = {}
             for lv_name, lv_settings in lvs.items():
                 check_type(f"lvm vg {name} lv {lv_name} entry", lv_settings, dict)
+                try:
+                    size = parse_size(lv_settings["size"], binary=True)
+                except InvalidSize as e:
+                    raise UserError(f"Invalid size of lvm vg {name} lv {lv_name}: {e}")
                 lvs_entities[lv_name] = LV(
                     name=lv_name,
                     layout=lv_settings["layout"],
-                    size=parse_size(lv_settings["size"], binary=True),
+                    size=size,
                 )
 
             entities.vgs[name] = VG(
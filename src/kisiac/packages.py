@@ -0,0 +1,338 @@
+import hashlib
+import io
+import os
+import shutil
+import subprocess as sp
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Self
+
+from kisiac.common import (
+    ArchiveEntry,
+    CommandBatch,
+    Singleton,
+    UserError,
+    cache,
+    log_action,
+    log_msg,
+    push_archive,
+    run_cmd,
+    stream_files,
+)
+from kisiac.runtime_settings import UpdateHostSettings
+
+apt_archives = Path("/var/cache/apt/archives")
+
+# touched whenever kisiac updated the package index of a host
+apt_update_stamp = Path("/var/lib/kisiac/apt-updated")
+
+# location of the --package-repo index on the hosts
+repo_dir = Path("/var/lib/kisiac/repo")
+repo_source = Path("/etc/apt/sources.list.d/kisiac.list")
+
+# checksum names of apt-get --print-uris and the corresponding hashlib names
+checksum_algorithms = {
+    "MD5Sum": "md5",
+    "SHA1": "sha1",
+    "SHA256": "sha256",
+    "SHA512": "sha512",
+}
+
+
+@dataclass(frozen=True, slots=True)
+class PackageDownload:
+    uri: str
+    filename: str
+    size: int
+    # hashlib algorithm and hex digest, None if apt did not report a checksum
+    checksum: tuple[str, str] | None
+
+    @classmethod
+    def parse(cls, line: str) -> Self:
+        """Parse a line of the output of apt-get --print-uris."""
+        uri, filename, size, *fields = line.split()
+        checksum = None
+        if fields:
+            name, _, digest = fields[0].partition(":")
+            if name in checksum_algorithms:
+                checksum = (checksum_algorithms[name], digest.lower())
+        return cls(
+            uri=uri.strip("'"), filename=filename, size=int(size), checksum=checksum
+        )
+
+
+class PackageCache(Singleton):
+    """Controller side cache of .deb files, shared by all updated hosts."""
+
+    def __init__(self) -> None:
+        self.path = cache / "debs"
+        self._lock = threading.Lock()
+        self._file_locks: dict[str, threading.Lock] = {}
+        self._index_lock = threading.Lock()
+        self._repo_indexes: dict[Path, Path] = {}
+
+    def repo_index(self, repo: Path) -> Path:
+        """Return the Packages index of the given flat repository.
+
+        If the repo has none, it is generated from the .deb files like
+        dpkg-scanpackages does, once per run.
+        """
+        index = repo / "Packages"
+        if index.exists():
+            return index
+        with self._index_lock:
+            if repo not in self._repo_indexes:
+                debs = sorted(repo.rglob("*.deb"))
+                if not debs:
+                    raise UserError(f"Package repo {repo} contains no .deb files")
+                log_msg(f"Generating the Packages index of {len(debs)} packages")
+                generated = cache / "repo-index" / "Packages"
+                generated.parent.mkdir(parents=True, exist_ok=True)
+                generated.write_text(
+                    "".join(
+                        packages_stanza(deb, f"./{deb.relative_to(repo)}") + "\n"
+                        for deb in debs
+                    )
+                )
+                self._repo_indexes[repo] = generated
+            return self._repo_indexes[repo]
+
+    def fetch(self, package: PackageDownload) -> Path:
+        """Return the cached file of the package, downloading it if needed.
+
+        Packages are taken from --package-repo if present there.
+        """
+        with self._lock:
+            lock = self._file_locks.setdefault(package.filename, threading.Lock())
+        with lock:
+            path = self.path / package.filename
+            if path.exists() and self._valid(path, package):
+                return path
+            self.path.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    local = self._repo_file(package)
+                    if local is not None:
+                        with open(local, "rb") as f:
+                            shutil.copyfileobj(f, out)
+                    else:
+                        log_msg("Downloading", package.uri)
+                        try:
+                            with urllib.request.urlopen(package.uri) as response:
+                                shutil.copyfileobj(response, out)
+                        except OSError as e:
+                            raise UserError(
+                                f"Failed to download {package.uri}: {e}"
+                            ) from e
+                if not self._valid(Path(tmp), package):
+                    raise UserError(
+                        f"Checksum of {package.filename} does not match the "
+                        "package index of the host"
+                    )
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+            return path
+
+    def _repo_file(self, package: PackageDownload) -> Path | None:
+        repo = UpdateHostSettings.get_instance().package_repo
+        if repo is None:
+            return None
+        # packages resolved against the pushed repo index refer to its copy
+        # on the host, which corresponds to the same path below the repo
+        prefix = f"file:{repo_dir}/"
+        if package.uri.startswith(prefix):
+            return repo / urllib.parse.unquote(package.uri.removeprefix(prefix))
+        if (repo / package.filename).exists():
+            return repo / package.filename
+        return None
+
+    def _valid(self, path: Path, package: PackageDownload) -> bool:
+        if path.stat().st_size != package.size:
+            return False
+        if package.checksum is None:
+            return True
+        algorithm, expected = package.checksum
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+        return digest.hexdigest() == expected
+
+
+def deb_control(path: Path) -> str:
+    """Return the control file of the given .deb package."""
+    with open(path, "rb") as f:
+        if f.read(8) != b"!<arch>\n":
+            raise UserError(f"{path} is not a .deb package")
+        # members of the ar archive, each with a header of 60 bytes
+        while len(header := f.read(60)) == 60:
+            name = header[:16].decode().strip().rstrip("/")
+            size = int(header[48:58])
+            data = f.read(size)
+            # members are aligned to 2 bytes
+            f.read(size % 2)
+            if not name.startswith("control.tar"):
+                continue
+            try:
+                with tarfile.open(fileobj=io.BytesIO(data)) as control:
+                    for member in control.getmembers():
+                        if member.name in ("control", "./control"):
+                            content = control.extractfile(member)
+                            assert content is not None
+                            return content.read().decode()
+            except tarfile.ReadError as e:
+                raise UserError(
+                    f"Cannot read {name} of {path} ({e}), create the Packages "
+                    "index with 'dpkg-scanpackages . > Packages' instead"
+                ) from e
+    raise UserError(f"{path} lacks a control file")
+
+
+def packages_stanza(path: Path, filename: str) -> str:
+    """Return the entry of the given .deb package in a Packages index."""
+    digests = {name: hashlib.new(name) for name in ("md5", "sha1", "sha256")}
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            for digest in digests.values():
+                digest.update(chunk)
+    fields = [
+        f"Filename: {filename}",
+        f"Size: {path.stat().st_size}",
+        f"MD5sum: {digests['md5'].hexdigest()}",
+        f"SHA1: {digests['sha1'].hexdigest()}",
+        f"SHA256: {digests['sha256'].hexdigest()}",
+    ]
+    return deb_control(path).rstrip("\n") + "\n" + "\n".join(fields) + "\n"
+
+
+def index_update_cmds() -> list[list[str]]:
+    """Return the commands updating the package index of a host."""
+    return [
+        ["apt-get", "update"],
+        ["mkdir", "-p", str(apt_update_stamp.parent)],
+        ["touch", str(apt_update_stamp)],
+    ]
+
+
+def provide_packages(
+    host: str, install: list[str], upgrade: bool, update_index: bool
+) -> None:
+    """Provide the packages needed on the host from the controller.
+
+    With --package-repo, the host resolves the packages against the index
+    of the repo, such that it needs no access to the package mirrors.
+    Otherwise, the outdated index of the host is updated first, falling back
+    to the existing index for hosts without access to the mirrors.
+    """
+    repo = UpdateHostSettings.get_instance().package_repo
+    if repo is not None:
+        push_repo_index(host, repo)
+    elif update_index:
+        try:
+            for cmd in index_update_cmds():
+                run_cmd(cmd, sudo=True, host=host, user_error=False)
+        except sp.CalledProcessError:
+            log_action(host, "apt-get update failed, using the existing index")
+    push_packages(host, install, upgrade)
+
+
+def push_repo_index(host: str, repo: Path) -> None:
+    """Register the index of the given flat repository as package source.
+
+    The source is only meant for the installation, afterwards it is removed
+    with repo_index_removal_cmds.
+    """
+    index = PackageCache.get_instance().repo_index(repo)
+    push_archive(
+        [
+            ArchiveEntry(
+                path=repo_dir, content=None, mode=0o755, owner="root", group="root"
+            ),
+            ArchiveEntry(
+                path=repo_source,
+                content=f"deb [trusted=yes] file:{repo_dir} ./\n",
+                mode=0o644,
+                owner="root",
+                group="root",
+            ),
+        ],
+        host=host,
+        sudo=True,
+    )
+    stream_files([(index, repo_dir / "Packages")], host=host, sudo=True)
+    # only read the repo index, the other sources are left untouched
+    run_cmd(
+        [
+            "apt-get",
+            "update",
+            "-o",
+            f"Dir::Etc::sourcelist={repo_source}",
+            "-o",
+            "Dir::Etc::sourceparts=-",
+            "-o",
+            "APT::Get::List-Cleanup=0",
+        ],
+        sudo=True,
+        host=host,
+    )
+
+
+def repo_index_removal_cmds() -> list[list[str]]:
+    """Return the commands removing the source registered by push_repo_index."""
+    # apt names its lists after the URI of the source
+    lists = f"/var/lib/apt/lists/{str(repo_dir).replace('/', '_')}_*"
+    return [
+        ["rm", "-f", repo_source],
+        ["rm", "-rf", repo_dir],
+        ["rm", "-f", lists],
+    ]
+
+
+def resolve_packages(
+    host: str, install: list[str], upgrade: bool
+) -> list[PackageDownload]:
+    """Return the packages the host would have to download for the given actions."""
+    with CommandBatch(host=host, sudo=True) as batch:
+        if upgrade:
+            batch.add(["apt-get", "upgrade", "--print-uris", "-qq", "-y"])
+        if install:
+            batch.add(["apt-get", "install", "--print-uris", "-qq", "-y", *install])
+    packages = {}
+    for ret in batch.results:
+        for line in ret.stdout.splitlines():
+            if line.startswith("'"):
+                package = PackageDownload.parse(line)
+                packages[package.filename] = package
+    return list(packages.values())
+
+
+def push_packages(host: str, install: list[str], upgrade: bool) -> None:
+    """Provide the packages needed on the host from the controller cache.
+
+    The packages are placed in the apt archives of the host, such that apt-get
+    can install them without downloading anything.
+    """
+    packages = resolve_packages(host, install, upgrade)
+    cache = PackageCache.get_instance()
+    stream_files(
+        [
+            (cache.fetch(package), apt_archives / package.filename)
+            for package in packages
+        ],
+        host=host,
+        sudo=True,
+    )
+    log_action(
+        host,
+        f"Pushed {len(packages)} packages "
+        f"({sum(package.size for package in packages) / 2**20:.1f} MiB) "
+        "from the controller cache",
+    )
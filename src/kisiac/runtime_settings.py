@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field, fields
 from argparse import ArgumentParser, Namespace
+from pathlib import Path
 from typing import Self, get_args, get_origin
 
 from kisiac.common import Singleton
@@ -61,6 +62,20 @@ class GlobalSettings(SettingsBase):
     non_interactive: bool = field(
         default=False, metadata={"help": "Run in non-interactive mode"}
     )
+    offline: bool = field(
+        default=False,
+        metadata={
+            "help": "Do not fetch updates of the config repo, but use the cached copy"
+        },
+    )
+    fetch_ttl: int = field(
+        default=0,
+        metadata={
+            "help": "Do not fetch updates of the config repo if the cached copy "
+            "has been refreshed less than the given number of seconds ago "
+            "(default: always fetch)"
+        },
+    )
 
 
 @dataclass
@@ -69,6 +84,69 @@ class UpdateHostSettings(SettingsBase):
         default=False,
         metadata={"help": "Skip system package upgrades"},
     )
+    apt_index_ttl: int = field(
+        default=3600,
+        metadata={
+            "help": "Seconds after which the package index of a host is "
+            "considered outdated, such that apt-get update is run again"
+        },
+    )
+    package_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "Download the needed system packages once on the controller "
+            "and push them to the hosts instead of letting each host download them"
+        },
+    )
+    package_repo: Path | None = field(
+        default=None,
+        metadata={
+            "help": "Flat repository with .deb files, against which the hosts "
+            "resolve packages without accessing the package mirrors (implies "
+            "--package-cache). A missing Packages index is generated from the "
+            ".deb files like with dpkg-scanpackages",
+            "metavar": "DIR",
+        },
+    )
+    full: bool = field(
+        default=False,
+        metadata={
+            "help": "Deploy everything instead of only what changed since the "
+            "last deployment to the respective host"
+        },
+    )
+    no_agent: bool = field(
+        default=False,
+        metadata={
+            "help": "Do not run the kisiac agent on the hosts, but issue "
+            "individual commands instead"
+        },
+    )
+    jobs: int = field(
+        default=1,
+        metadata={"help": "Number of hosts to update concurrently"},
+    )
+    permission_workers: int = field(
+        default=8,
+        metadata={
+            "help": "Number of parallel workers the kisiac agent uses for "
+            "applying permissions to directory trees"
+        },
+    )
+    user_software_jobs: int = field(
+        default=4,
+        metadata={
+            "help": "Number of users for which the user software is installed "
+            "concurrently on each host"
+        },
+    )
+    asyncio: bool = field(
+        default=False,
+        metadata={
+            "help": "Drive the host updates from a single asyncio event loop "
+            "instead of a thread per concurrently updated host"
+        },
+    )
     hosts: list[str] = field(
         default_factory=lambda: ["localhost"],
         metadata={
@@ -78,3 +156,7 @@ class UpdateHostSettings(SettingsBase):
             "metavar": "HOST",
         },
     )
+
+    @classmethod
+    def parse_package_repo(cls, value: str) -> Path:
+        return Path(value).expanduser()
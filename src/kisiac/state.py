@@ -0,0 +1,215 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from kisiac.common import Singleton, cache, kisiac_version, log_action, run_cmd
+from kisiac.config import Changes, Config, digest_json
+from kisiac.runtime_settings import UpdateHostSettings
+
+state_db_path = cache / "state.sqlite"
+
+# Stamps of the applied phases on the hosts, used for verifying that the
+# local journal is still valid for the host (e.g. it has not been reinstalled).
+remote_stamp_dir = Path("/var/lib/kisiac/phases")
+
+# config sections the respective phases depend on
+phase_sections = {
+    "update_lvm": ("lvm",),
+    "update_filesystems": ("filesystems",),
+    "setup_users": ("users",),
+    # owners and groups may be users and groups created by setup_users
+    "update_permissions": ("permissions", "users"),
+    "setup_user_software": ("users", "user_software"),
+}
+
+
+class StateStore(Singleton):
+    """Local record of the deployments to the hosts."""
+
+    def __init__(self) -> None:
+        state_db_path.parent.mkdir(parents=True, exist_ok=True)
+        # shared by the concurrent host updates, serialized via the lock
+        self._db = sqlite3.connect(state_db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._changes: dict[tuple[str, str], Changes | None] = {}
+        self._remote_stamps: dict[str, dict[str, str]] = {}
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS deployments ("
+                "host TEXT NOT NULL, "
+                "phase TEXT NOT NULL, "
+                "commit_sha TEXT NOT NULL, "
+                "fingerprints TEXT NOT NULL, "
+                "time REAL NOT NULL, "
+                "PRIMARY KEY (host, phase))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS phases ("
+                "host TEXT NOT NULL, "
+                "phase TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, "
+                "result TEXT NOT NULL, "
+                "time REAL NOT NULL, "
+                "PRIMARY KEY (host, phase))"
+            )
+
+    def deployment(self, host: str, phase: str) -> tuple[str, dict[str, Any]] | None:
+        """Return commit and fingerprints of the last run of the file phase."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT commit_sha, fingerprints FROM deployments "
+                "WHERE host = ? AND phase = ?",
+                (host, phase),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def record_deployment(self, host: str, phase: str) -> None:
+        """Record that the file phase has deployed the current config to the host.
+
+        Only phases that actually ran are recorded, such that changes are
+        always determined against what has been deployed.
+        """
+        config = Config.get_instance().for_host(host)
+        commit = config.files.repo.head.commit.hexsha
+        fingerprints = json.dumps(config.fingerprints())
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO deployments VALUES (?, ?, ?, ?, ?)",
+                (host, phase, commit, fingerprints, time.time()),
+            )
+
+    def changes(self, host: str, phase: str) -> Changes | None:
+        """Return the changes since the last run of the file phase on the host.
+
+        Returns None if everything has to be deployed, i.e. with --full, for
+        new hosts or if the last deployed commit is not available anymore.
+        The result is determined once per run.
+        """
+        with self._lock:
+            if (host, phase) in self._changes:
+                return self._changes[host, phase]
+        changes = self._determine_changes(host, phase)
+        with self._lock:
+            self._changes[host, phase] = changes
+        return changes
+
+    def _determine_changes(self, host: str, phase: str) -> Changes | None:
+        if UpdateHostSettings.get_instance().full:
+            return None
+        deployment = self.deployment(host, phase)
+        if deployment is None:
+            return None
+        commit, fingerprints = deployment
+        config = Config.get_instance().for_host(host)
+        paths = config.files.changed_paths(commit)
+        if paths is None:
+            log_action(
+                host,
+                f"Last deployed commit {commit[:8]} not available, "
+                "deploying everything",
+            )
+            return None
+        return Changes.between(fingerprints, config.fingerprints(), paths)
+
+    def phase_fingerprint(self, host: str, phase: str) -> str | None:
+        """Return the fingerprint of the inputs of the phase on the host.
+
+        Besides the config, the inputs comprise the kisiac version, since
+        phases and their defaults may change between releases. Returns None
+        if the phase has to be run regardless of its inputs.
+        """
+        config = Config.get_instance().for_host(host)
+        settings = UpdateHostSettings.get_instance()
+        if phase == "update_system_packages":
+            if not settings.skip_system_upgrade:
+                # upgrades depend on the package archives rather than on the config
+                return None
+            # including the default packages
+            return digest_json(
+                [phase, kisiac_version, config.snapshot.system_packages()]
+            )
+        if phase in phase_sections:
+            return digest_json(
+                [
+                    phase,
+                    kisiac_version,
+                    *map(config.section_digest, phase_sections[phase]),
+                ]
+            )
+        # file deployments depend on the repo contents and all variables
+        return digest_json(
+            [
+                phase,
+                kisiac_version,
+                config.files.repo.head.commit.hexsha,
+                config.fingerprints(),
+            ]
+        )
+
+    def skip_phase(self, host: str, phase: str, fingerprint: str | None) -> bool:
+        """Return whether the phase has already been applied with equal inputs.
+
+        Besides the local journal, this is verified via the stamps on the host.
+        """
+        if fingerprint is None or UpdateHostSettings.get_instance().full:
+            return False
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprint, result FROM phases WHERE host = ? AND phase = ?",
+                (host, phase),
+            ).fetchone()
+        if row is None or row[0] != fingerprint:
+            return False
+        if self.remote_stamps(host).get(phase) != fingerprint:
+            log_action(host, f"Remote stamp of {phase} does not match, rerunning it")
+            return False
+        log_action(host, f"Skipping {phase}, unchanged since last run ({row[1]})")
+        return True
+
+    def record_phase(
+        self, host: str, phase: str, fingerprint: str | None, result: str = "ok"
+    ) -> None:
+        """Record the successful application of the phase with the given inputs."""
+        if fingerprint is None:
+            return
+        run_cmd(
+            [
+                (
+                    f"mkdir -p {remote_stamp_dir} && "
+                    f"echo {fingerprint} > {remote_stamp_dir / phase}"
+                )
+            ],
+            host=host,
+            sudo=True,
+            keep_stat_cache=True,
+        )
+        with self._lock, self._db:
+            self._remote_stamps.setdefault(host, {})[phase] = fingerprint
+            self._db.execute(
+                "INSERT OR REPLACE INTO phases VALUES (?, ?, ?, ?, ?)",
+                (host, phase, fingerprint, result, time.time()),
+            )
+
+    def remote_stamps(self, host: str) -> dict[str, str]:
+        """Return the stamps of the phases on the host, read once per run."""
+        with self._lock:
+            if host in self._remote_stamps:
+                return self._remote_stamps[host]
+        output = run_cmd(
+            [f"grep -rH . {remote_stamp_dir} 2>/dev/null || true"],
+            host=host,
+            sudo=True,
+            keep_stat_cache=True,
+        ).stdout
+        stamps = {}
+        for line in output.splitlines():
+            path, _, fingerprint = line.partition(":")
+            stamps[Path(path).name] = fingerprint
+        with self._lock:
+            self._remote_stamps[host] = stamps
+        return stamps
@@ -1,32 +1,36 @@
+from collections.abc import Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import subprocess as sp
 import sys
+
 from kisiac.common import (
+    CommandBatch,
     HostAgnosticPath,
     UserError,
+    agent_session,
     cmd_to_str,
     confirm_action,
     log_action,
+    log_msg,
     run_cmd,
 )
-from kisiac.filesystems import DeviceInfos, update_filesystems
+from kisiac.filesystems import DeviceInfos, update_filesystems, update_permissions
 from kisiac.runtime_settings import GlobalSettings, UpdateHostSettings
 from kisiac import users
-from kisiac.config import Config
+from kisiac.config import Config, File, Ownership, system_ownership, write_files
 from kisiac.lvm import LVMSetup
+from kisiac.packages import (
+    apt_update_stamp,
+    index_update_cmds,
+    provide_packages,
+    repo_index_removal_cmds,
+)
+from kisiac.state import StateStore
 
 import inquirer
 
 
-default_system_software = [
-    "openssh-server",
-    "openssh-client",
-    "lvm2",
-    "e2fsprogs",
-    "xfsprogs",
-    "btrfs-progs",
-]
-
-
 def setup_config() -> None:
     if GlobalSettings.get_instance().non_interactive:
         content = sys.stdin.read()
@@ -44,11 +48,54 @@ def setup_config() -> None:
     HostAgnosticPath("/etc/kisiac.yaml", sudo=True).write_text(content)
 
 
+def update_hosts(hosts: Sequence[str], jobs: int) -> None:
+    """Update the given hosts with at most jobs hosts being updated concurrently.
+
+    Errors of individual hosts do not abort the update of the other hosts.
+    Instead, a summary is logged and a UserError is raised at the end.
+    """
+    if jobs < 1:
+        raise UserError("The number of jobs has to be at least 1.")
+    # Set up the config before spawning workers, such that they all share it.
+    Config.get_instance().for_hosts(hosts)
+
+    def update(host: str) -> UserError | None:
+        try:
+            update_host(host)
+        except UserError as e:
+            log_action(host, "Update failed:", e)
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        errors = dict(zip(hosts, executor.map(update, hosts)))
+
+    summarize_updates(errors)
+
+
+def summarize_updates(errors: dict[str, UserError | None]) -> None:
+    log_msg("Summary:")
+    failed = []
+    for host, error in errors.items():
+        if error is None:
+            log_action(host, "succeeded")
+        else:
+            log_action(host, "failed:", error)
+            failed.append(host)
+    if failed:
+        raise UserError(
+            f"Update failed for {len(failed)} of {len(errors)} hosts: "
+            f"{', '.join(failed)}"
+        )
+
+
 def update_host(host: str) -> None:
-    config = Config.get_instance()
-    for file in config.files.get_files(user=None):
-        log_action(host, "Updating system file", file.target_path)
-        file.write(overwrite_existing=True, host=host, sudo=True)
+    with agent_session(host):
+        _update_host(host)
+
+
+def _update_host(host: str) -> None:
+    update_system_files(host)
 
     update_system_packages(host)
 
@@ -57,30 +104,197 @@ def update_host(host: str) -> None:
     update_filesystems(host)
 
     users.setup_users(host=host)
-    for user in config.users:
-        for file in config.files.get_files(user.username):
-            log_action(host, "Updating user file", file.target_path)
-            # If the user already has the files, we leave him the new file as a
-            # template next to the actual file, with the suffix '.updated'.
-            user.fix_permissions(
-                file.write(overwrite_existing=False, host=host, sudo=True), host=host
-            )
 
+    update_permissions(host)
 
-def update_system_packages(host: str) -> None:
-    run_cmd(["apt-get", "update"], sudo=True, host=host)
-    if not UpdateHostSettings.get_instance().skip_system_upgrade:
-        run_cmd(["apt-get", "upgrade"], sudo=True, host=host)
-    run_cmd(
-        ["apt-get", "install"]
-        + list(set(Config.get_instance().system_software + default_system_software)),
-        sudo=True,
-        host=host,
+    update_user_files(host)
+
+    users.setup_user_software(host)
+
+
+def system_files(host: str) -> list[tuple[File, Ownership]]:
+    changes = StateStore.get_instance().changes(host, "update_system_files")
+    return [
+        (file, system_ownership)
+        for file in Config.get_instance().files.get_files(
+            user=None, host=host, changes=changes
+        )
+    ]
+
+
+def user_files(host: str) -> list[tuple[File, Ownership]]:
+    config = Config.get_instance().for_host(host)
+    changes = StateStore.get_instance().changes(host, "update_user_files")
+    return [
+        (file, user.ownership)
+        for user in config.snapshot.users
+        for file in config.files.get_files(user.username, host=host, changes=changes)
+    ]
+
+
+def update_system_files(host: str) -> None:
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "update_system_files")
+    if journal.skip_phase(host, "update_system_files", fingerprint):
+        return
+    written = write_files(system_files(host), overwrite_existing=True, host=host)
+    for path in written:
+        log_action(host, "Updated system file", path)
+    journal.record_deployment(host, "update_system_files")
+    journal.record_phase(
+        host, "update_system_files", fingerprint, f"{len(written)} files written"
+    )
+
+
+def update_user_files(host: str) -> None:
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "update_user_files")
+    if journal.skip_phase(host, "update_user_files", fingerprint):
+        return
+    # If the user already has the files, we leave him the new file as a
+    # template next to the actual file, with the suffix '.updated'.
+    written = write_files(user_files(host), overwrite_existing=False, host=host)
+    for path in written:
+        log_action(host, "Updated user file", path)
+    journal.record_deployment(host, "update_user_files")
+    journal.record_phase(
+        host, "update_user_files", fingerprint, f"{len(written)} files written"
+    )
+
+
+@dataclass
+class PackageState:
+    installed: dict[str, str]
+    # seconds since the package index was last updated, None if unknown
+    index_age: int | None
+
+    def missing(self, packages: Iterable[str]) -> list[str]:
+        """Return the packages that are not installed in the requested version."""
+        missing = []
+        for spec in packages:
+            name, _, version = spec.partition("=")
+            installed = self.installed.get(name.split(":")[0])
+            if installed is None or (version and installed != version):
+                missing.append(spec)
+        return sorted(missing)
+
+    def drift(self, packages: Iterable[str]) -> list[str]:
+        drift = []
+        for spec in self.missing(packages):
+            name, _, version = spec.partition("=")
+            installed = self.installed.get(name.split(":")[0])
+            if installed is None:
+                drift.append(f"{name} (not installed)")
+            else:
+                drift.append(f"{name} (installed {installed}, requested {version})")
+        return drift
+
+
+def package_state(host: str) -> PackageState:
+    """Query installed packages and the age of the package index in one go."""
+    with CommandBatch(host=host) as batch:
+        batch.add(
+            [
+                "dpkg-query",
+                "-W",
+                "--showformat='${Package}\\t${Version}\\t${db:Status-Abbrev}\\n'",
+            ]
+        )
+        batch.add(["date", "+%s"])
+        batch.add(
+            [
+                (
+                    f"stat -c %Y {apt_update_stamp} "
+                    "/var/lib/apt/periodic/update-success-stamp "
+                    "/var/lib/apt/lists 2>/dev/null | sort -n | tail -1"
+                )
+            ]
+        )
+    packages, now, updated = batch.results
+    installed = {}
+    for line in packages.stdout.splitlines():
+        name, version, status = line.split("\t")
+        if status.startswith("ii"):
+            installed[name] = version
+    index_age = (
+        int(now.stdout) - int(updated.stdout) if updated.stdout.strip() else None
     )
+    return PackageState(installed=installed, index_age=index_age)
+
+
+@dataclass
+class PackagePlan:
+    missing: list[str]
+    upgrade: bool
+    # whether the package index of the host is outdated
+    update_index: bool
+    # whether the packages are pushed from the controller
+    from_controller: bool
+
+
+def package_plan(host: str) -> PackagePlan:
+    """Determine the package actions for the host without changing anything."""
+    settings = UpdateHostSettings.get_instance()
+    packages = Config.get_instance().for_host(host).snapshot.system_packages()
+    state = package_state(host)
+    drift = state.drift(packages)
+    if drift:
+        log_action(host, "Package drift:", ", ".join(drift))
+    else:
+        log_action(host, f"No package drift, all {len(packages)} packages installed")
+
+    missing = state.missing(packages)
+    upgrade = not settings.skip_system_upgrade
+    return PackagePlan(
+        missing=missing,
+        upgrade=upgrade,
+        update_index=bool(missing or upgrade)
+        and (state.index_age is None or state.index_age > settings.apt_index_ttl),
+        from_controller=settings.package_cache or settings.package_repo is not None,
+    )
+
+
+def system_packages_cmds(plan: PackagePlan) -> list[list[str]]:
+    cmds = []
+    no_download = []
+    if plan.from_controller:
+        # the index has been prepared by provide_packages
+        no_download = ["--no-download"]
+    elif plan.update_index:
+        cmds += index_update_cmds()
+    if plan.upgrade:
+        cmds.append(["apt-get", "upgrade", "-y", *no_download])
+    if plan.missing:
+        cmds.append(["apt-get", "install", "-y", *no_download, *plan.missing])
+    return cmds
+
+
+def update_system_packages(host: str) -> None:
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "update_system_packages")
+    if journal.skip_phase(host, "update_system_packages", fingerprint):
+        return
+    plan = package_plan(host)
+    provided = plan.from_controller and bool(plan.missing or plan.upgrade)
+    try:
+        if provided:
+            provide_packages(host, plan.missing, plan.upgrade, plan.update_index)
+        for cmd in system_packages_cmds(plan):
+            run_cmd(cmd, sudo=True, host=host)
+    finally:
+        # the source of --package-repo is only registered for the installation
+        if provided and UpdateHostSettings.get_instance().package_repo is not None:
+            for cmd in repo_index_removal_cmds():
+                run_cmd(cmd, sudo=True, host=host)
+    journal.record_phase(host, "update_system_packages", fingerprint)
 
 
 def update_lvm(host: str) -> None:
-    desired = Config.get_instance().lvm
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "update_lvm")
+    if journal.skip_phase(host, "update_lvm", fingerprint):
+        return
+    desired = Config.get_instance().for_host(host).snapshot.lvm
     current = LVMSetup.from_system(host=host)
     device_infos = DeviceInfos(host)
 
@@ -186,10 +400,12 @@ def update_lvm(host: str) -> None:
         "\nProceed? If answering no, consider making the changes manually or "
         "adjust the kisiac LVM configuration."
     ):
-        for cmd in cmds:
-            try:
-                run_cmd(cmd, host=host, sudo=True, user_error=False)
-            except sp.CalledProcessError as e:
-                raise UserError(
-                    f"Incomplete LVM update due to error (make sure to manually fix this!): {e.stderr}"
-                )
+        try:
+            with CommandBatch(host=host, sudo=True) as batch:
+                for cmd in cmds:
+                    batch.add(cmd, user_error=False)
+        except sp.CalledProcessError as e:
+            raise UserError(
+                f"Incomplete LVM update due to error (make sure to manually fix this!): {e.stderr}"
+            )
+        journal.record_phase(host, "update_lvm", fingerprint, f"{len(cmds)} commands")
@@ -1,66 +1,241 @@
-import grp
-import pwd
+import shlex
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 
-from kisiac.common import HostAgnosticPath, log_action, run_cmd
-from kisiac.config import Config
+from kisiac.common import CommandBatch, UserError, log_action, run_cmd
+from kisiac.config import (
+    Config,
+    Package,
+    link_pixi_cache_cmd,
+    pixi_cache_dir,
+    pixi_cache_owner,
+    pixi_cache_owner_home,
+    pixi_install_cmd,
+    software_fingerprint,
+    user_pixi_cache,
+    user_software_stamp,
+)
+from kisiac.runtime_settings import UpdateHostSettings
+from kisiac.state import StateStore
 
 
 def setup_users(host: str) -> None:
-    users = list(Config.get_instance().users)
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "setup_users")
+    if journal.skip_phase(host, "setup_users", fingerprint):
+        return
+    users = Config.get_instance().for_host(host).snapshot.users
 
     groups = {group for user in users for group in user.secondary_groups} | {
         user.primary_group for user in users
     }
 
-    for group in groups:
-        # create group if it does not exist
-        if run_cmd(["getent", "group", group], check=False, host=host).returncode == 2:
-            run_cmd(["groupadd", group], host=host, sudo=True)
+    existing_users, existing_groups = get_existing_users_and_groups(host)
 
-    for user in Config.get_instance().users:
-        # create user if it does not exist
-        if not is_existing_user(user.username):
-            group_arg = []
-            if user.secondary_groups:
-                group_arg = ["-G", ",".join(user.secondary_groups)]
+    with CommandBatch(host=host, sudo=True) as batch:
+        for group in sorted(groups - existing_groups):
+            # create group if it does not exist
+            batch.add(["groupadd", group])
 
+        for user in users:
+            # create user if it does not exist
+            if user.username not in existing_users:
+                group_arg = []
+                if user.secondary_groups:
+                    group_arg = ["-G", ",".join(user.secondary_groups)]
+
+                batch.add(
+                    [
+                        "useradd",
+                        "-g",
+                        user.primary_group,
+                        *group_arg,
+                        "--shell",
+                        "/bin/bash",
+                        "-m",
+                        user.username,
+                    ]
+                )
+            else:
+                log_action(host, "Updating user", user.username)
+
+            owner = f"{user.username}:{user.primary_group}"
+            sshdir = f"~{user.username}/.ssh"
+            auth_keys_file = f"{sshdir}/authorized_keys"
+            batch.add(["mkdir", "-p", sshdir])
+            batch.add(["chown", "-R", owner, sshdir])
+            batch.add(["chmod", "-R", "u=rwx,g-rwx,o-rwx", sshdir])
+            batch.add(["tee", auth_keys_file], input=user.ssh_pub_key + "\n")
+            # ensure that only user may read/write the file
+            batch.add(["chmod", "u=rw,g-rwx,o-rwx", auth_keys_file])
+            batch.add(["chown", owner, auth_keys_file])
+    journal.record_phase(host, "setup_users", fingerprint, f"{len(users)} users")
+
+
+def setup_user_software(host: str) -> None:
+    """Install the user software of all users ahead of their first login.
+
+    Users whose software stamp matches the configured software are skipped.
+    The stamp is the same that the profile script checks on login.
+    """
+    journal = StateStore.get_instance()
+    fingerprint = journal.phase_fingerprint(host, "setup_user_software")
+    if journal.skip_phase(host, "setup_user_software", fingerprint):
+        return
+    snapshot = Config.get_instance().for_host(host).snapshot
+    software = software_fingerprint(snapshot.user_software)
+
+    with CommandBatch(host=host, sudo=True) as batch:
+        setup_pixi_cache(batch)
+        stamps_start = len(batch)
+        for user in snapshot.users:
+            batch.add(["cat", f"~{user.username}/{user_software_stamp}"], check=False)
+    pending = [
+        user
+        for user, ret in zip(snapshot.users, batch.results[stamps_start:])
+        if ret.stdout.strip() != software
+    ]
+
+    errors = []
+    if pending:
+        # fill the shared cache first, such that the users only link to it
+        errors = run_user_scripts(
+            host,
+            [pixi_cache_owner],
+            user_software_script(snapshot.user_software, software, shared_cache=True),
+            jobs=1,
+        )
+    if not errors:
+        errors = run_user_scripts(
+            host,
+            [user.username for user in pending],
+            user_software_script(snapshot.user_software, software),
+            jobs=UpdateHostSettings.get_instance().user_software_jobs,
+        )
+    if errors:
+        raise UserError(
+            f"Failed to install user software for {len(errors)} of "
+            f"{len(pending)} users, e.g.: {errors[0]}"
+        )
+    journal.record_phase(
+        host,
+        "setup_user_software",
+        fingerprint,
+        f"{len(pending)} of {len(snapshot.users)} users provisioned",
+    )
+
+
+def run_user_scripts(
+    host: str, usernames: Sequence[str], script: str, jobs: int
+) -> list[UserError]:
+    """Run the script as each of the given users, up to jobs at a time.
+
+    The scripts bypass the agent, which would run them one after another,
+    and return the errors of the failed ones.
+    """
+
+    def run(username: str) -> UserError | None:
+        log_action(host, "Running user script as", username)
+        try:
             run_cmd(
-                [
-                    "useradd",
-                    "-g",
-                    user.primary_group,
-                    *group_arg,
-                    "--shell",
-                    "/bin/bash",
-                    "-m",
-                    user.username,
-                ],
+                ["su", "-", username, "-c", shlex.quote("bash -s")],
+                input=script,
                 host=host,
                 sudo=True,
+                use_agent=False,
+            )
+        except UserError as e:
+            log_action(host, f"User script of {username} failed")
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return [e for e in executor.map(run, usernames) if e is not None]
+
+
+def setup_pixi_cache(batch: CommandBatch) -> None:
+    """Set up the package cache shared by the users of the host.
+
+    Only the dedicated cache account writes to the cache, everybody else may
+    only read it.
+    """
+    batch.add(
+        [
+            (
+                f"getent group {pixi_cache_owner} > /dev/null || "
+                f"groupadd --system {pixi_cache_owner}"
+            )
+        ]
+    )
+    batch.add(
+        [
+            (
+                f"id -u {pixi_cache_owner} > /dev/null 2>&1 || "
+                f"useradd --system -g {pixi_cache_owner} "
+                f"-d {pixi_cache_owner_home} -m --shell /bin/bash {pixi_cache_owner}"
             )
-        else:
-            log_action("Updating user", user.username)
-
-        sshdir = HostAgnosticPath(f"~{user.username}/.ssh", host=host, sudo=True)
-        sshdir.mkdir()
-        sshdir.chown(user.username, user.primary_group)
-        sshdir.chmod("u=rwx", "g-rwx", "o-rwx")
-        auth_keys_file = sshdir / "authorized_keys"
-        auth_keys_file.write_text(user.ssh_pub_key + "\n")
-        user.fix_permissions([auth_keys_file.path], host=host)
-
-
-def is_existing_user(username: str) -> bool:
-    try:
-        pwd.getpwnam(username)
-        return True
-    except KeyError:
-        return False
-
-
-def is_existing_group(groupname: str, host: str) -> bool:
-    try:
-        grp.getgrnam(groupname)
-        return True
-    except KeyError:
-        return False
+        ]
+    )
+    batch.add(
+        [
+            "install",
+            "-d",
+            "-o",
+            pixi_cache_owner,
+            "-g",
+            pixi_cache_owner,
+            "-m",
+            "755",
+            pixi_cache_dir,
+        ]
+    )
+
+
+def user_software_script(
+    packages: Sequence[Package], fingerprint: str, shared_cache: bool = False
+) -> str:
+    """Return the script installing the packages, run as the respective user.
+
+    Like the profile script, commands that are already present are not
+    installed again. With shared_cache, the packages are installed into the
+    shared cache, readable by everybody. Otherwise, pixi uses the cache of the
+    user, which overlays the shared cache, such that nothing is downloaded or
+    unpacked twice.
+    """
+    lines = ['export PATH="$HOME/.pixi/bin:$PATH"']
+    if shared_cache:
+        lines += [
+            "umask 022",
+            f"export PIXI_CACHE_DIR={pixi_cache_dir}",
+            f"export RATTLER_CACHE_DIR={pixi_cache_dir}",
+        ]
+    else:
+        lines += [
+            f'export PIXI_CACHE_DIR="$HOME/{user_pixi_cache}"',
+            'export RATTLER_CACHE_DIR="$PIXI_CACHE_DIR"',
+            f"{link_pixi_cache_cmd} || exit 1",
+        ]
+    lines.append(f"command -v pixi > /dev/null || {{ {pixi_install_cmd}; }} || exit 1")
+    for pkg in packages:
+        lines.append(
+            f"command -v {shlex.quote(pkg.cmd)} > /dev/null || "
+            f"{{ {pkg.install_cmd}; }} || exit 1"
+        )
+    lines.append(
+        f'mkdir -p "$HOME/{user_software_stamp.parent}" && '
+        f'echo {fingerprint} > "$HOME/{user_software_stamp}"'
+    )
+    return "\n".join(lines) + "\n"
+
+
+def get_existing_users_and_groups(host: str) -> tuple[set[str], set[str]]:
+    """Return the names of all users and groups on the host."""
+    with CommandBatch(host=host) as batch:
+        batch.add(["getent", "passwd"])
+        batch.add(["getent", "group"])
+    passwd, group = batch.results
+
+    def names(output: str) -> set[str]:
+        return {line.split(":", 1)[0] for line in output.splitlines() if line}
+
+    return names(passwd.stdout), names(group.stdout)
@@ -1,4 +1,47 @@
+import dataclasses
+import grp
+import io
+import os
+import pwd
+import re
 import subprocess as sp
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+import jinja2
+import pytest
+import yaml
+
+from kisiac.agent import apply_symbolic_mode
+from kisiac.common import (
+    Agent,
+    ArchiveEntry,
+    CommandBatch,
+    PathStat,
+    PermissionTarget,
+    UserError,
+    apply_permissions,
+    push_archive,
+)
+from kisiac import common, config, packages, state, users
+from kisiac.config import (
+    Changes,
+    Config,
+    ConfigSnapshot,
+    File,
+    HostIndex,
+    Ownership,
+    YamlCache,
+    plan_files,
+    write_files,
+)
+from kisiac.packages import PackageCache, PackageDownload
+from kisiac.runtime_settings import GlobalSettings, UpdateHostSettings
+from kisiac.state import StateStore
+from kisiac.update import PackageState
+from kisiac.users import run_user_scripts
 
 
 def test_all():
@@ -14,3 +57,681 @@ def test_all():
             ],
             check=True,
         )
+
+
+def test_user_scripts_run_concurrently(monkeypatch):
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def run_cmd(cmd, **kwargs):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        if cmd[2] == "broken":
+            raise UserError("failed")
+
+    monkeypatch.setattr(users, "run_cmd", run_cmd)
+    errors = run_user_scripts("localhost", ["a", "b", "broken", "c"], "true\n", 4)
+    assert max_running[0] > 1
+    assert [str(e) for e in errors] == ["failed"]
+
+
+def test_agent_round_trip(tmp_path):
+    agent = Agent("localhost", sudo=False)
+    try:
+        path = tmp_path / "dir" / "file"
+        results = agent.call_many(
+            [
+                ("mkdir", {"path": str(path.parent)}),
+                ("write", {"path": str(path), "content": "content", "mode": 0o640}),
+                ("read", {"path": str(path)}),
+                ("exec", {"cmd": "cat; echo err >&2; exit 3", "input": "input"}),
+            ]
+        )
+        assert results[2] == "content"
+        assert results[3] == {"returncode": 3, "stdout": "input", "stderr": "err\n"}
+        assert path.stat().st_mode & 0o777 == 0o640
+        # failing requests are reported without terminating the agent
+        with pytest.raises(UserError, match="FileNotFoundError"):
+            agent.call("read", path=str(tmp_path / "missing"))
+        with pytest.raises(UserError, match="unknown"):
+            agent.call("unknown")
+        assert agent.call("read", path=str(path)) == "content"
+    finally:
+        agent.close()
+
+
+@pytest.mark.parametrize(
+    "mode,spec,is_dir,expected",
+    [
+        (0o755, "u+s", False, 0o4755),
+        (0o755, "u+s", True, 0o4755),
+        # like chmod, '=' keeps the setgid bit of directories only
+        (0o2775, "g=", True, 0o2705),
+        (0o2775, "g=", False, 0o705),
+        (0o2755, "g-s", True, 0o755),
+        (0o755, "o-x", True, 0o754),
+        (0o644, "a+X", False, 0o644),
+        (0o744, "a+X", False, 0o755),
+        (0o644, "a+X", True, 0o755),
+        (0o755, "+t", True, 0o1755),
+        (0o644, "u=rw,go=", False, 0o600),
+    ],
+)
+def test_apply_symbolic_mode(mode, spec, is_dir, expected):
+    assert apply_symbolic_mode(mode, spec, is_dir) == expected
+
+
+def test_apply_symbolic_mode_invalid():
+    with pytest.raises(ValueError):
+        apply_symbolic_mode(0o644, "u+q", False)
+    with pytest.raises(ValueError):
+        apply_symbolic_mode(0o644, "u", False)
+
+
+def test_command_batch_output(tmp_path):
+    with CommandBatch() as batch:
+        batch.add(["printf", "'a\\nb ü'"])
+        batch.add(["cat"], input="line 1\nline 2\n")
+        batch.add(["echo out; echo err >&2; exit 2"], check=False)
+        batch.add(["true"])
+    assert [ret.stdout for ret in batch.results] == [
+        "a\nb ü",
+        "line 1\nline 2\n",
+        "out\n",
+        "",
+    ]
+    assert [ret.returncode for ret in batch.results] == [0, 0, 2, 0]
+    assert batch.results[2].stderr == "err\n"
+
+
+def test_command_batch_stops_at_failure(tmp_path):
+    marker = tmp_path / "marker"
+    batch = CommandBatch()
+    batch.add(["echo", "first"])
+    batch.add(["echo failure >&2; exit 1"])
+    batch.add(["touch", str(marker)])
+    with pytest.raises(UserError, match="failure"):
+        batch.run()
+    # the commands after the failing one are not run
+    assert not marker.exists()
+    assert [ret.returncode for ret in batch.results] == [0, 1]
+    assert batch.results[0].stdout == "first\n"
+
+
+@pytest.fixture
+def no_sudo(monkeypatch):
+    """Run commands like sudo bash -c would do, but as the current user."""
+    monkeypatch.setattr(
+        common, "wrap_cmd", lambda cmd, host, sudo: ["bash", "-c", " ".join(cmd)]
+    )
+    owner = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    return owner, group
+
+
+def test_apply_permissions_repairs_drifted_entries(tmp_path, no_sudo):
+    owner, group = no_sudo
+    root = tmp_path / "root"
+    (root / "sub").mkdir(parents=True)
+    (root / "sub" / "file").touch()
+    root.chmod(0o750)
+    (root / "sub").chmod(0o750)
+    # compliant root and parent, but a drifted entry below
+    (root / "sub" / "file").chmod(0o666)
+    mode = "u+r,g+r,o-r,u+w,g-w,o-w"
+    targets = [
+        PermissionTarget(root, mode, mode, owner, group),
+        PermissionTarget(root, "o-x", "o-x", None, None, recursive=False),
+    ]
+
+    assert apply_permissions(targets, host="localhost") == [1, 0]
+    assert (root / "sub" / "file").stat().st_mode & 0o777 == 0o640
+    assert root.stat().st_mode & 0o777 == 0o750
+    assert apply_permissions(targets, host="localhost") == [0, 0]
+
+
+def test_write_files_skips_unchanged(tmp_path, no_sudo):
+    ownership = Ownership(*no_sudo, file_mode=0o644, dir_mode=0o755)
+    same, changed, new = tmp_path / "same", tmp_path / "changed", tmp_path / "d/new"
+    same.write_text("same\n")
+    changed.write_text("old\n")
+    files = [
+        (File(same, "same\n"), ownership),
+        (File(changed, "changed\n"), ownership),
+        (File(new, "new\n"), ownership),
+    ]
+
+    # only targets whose checksum differs are written
+    assert write_files(files, overwrite_existing=True, host="localhost") == [
+        changed,
+        new,
+    ]
+    assert changed.read_text() == "changed\n"
+    assert new.read_text() == "new\n"
+    assert write_files(files, overwrite_existing=True, host="localhost") == []
+
+
+def test_host_index(tmp_path):
+    base, infra = tmp_path / "all", tmp_path / "infra"
+    for path in [
+        base / "hosts" / "all",
+        infra / "hosts" / "node*",
+        infra / "hosts" / "node1",
+        infra / "hosts" / "gpu*.example",
+        infra / "hosts" / "all",
+    ]:
+        path.mkdir(parents=True)
+    index = HostIndex([base, infra])
+
+    assert index.resolve("node1") == [
+        base / "hosts" / "all",
+        infra / "hosts" / "all",
+        infra / "hosts" / "node*",
+        infra / "hosts" / "node1",
+    ]
+    # '*' matches a non-empty sequence of characters, dots are literal
+    assert infra / "hosts" / "node*" not in index.resolve("node")
+    assert infra / "hosts" / "gpu*.example" in index.resolve("gpu1.example")
+    assert infra / "hosts" / "gpu*.example" not in index.resolve("gpu1xexample")
+    assert index.resolve_many(["other"], include_infrastructure_root=True) == {
+        "other": [base, base / "hosts" / "all", infra, infra / "hosts" / "all"]
+    }
+
+    (infra / "hosts" / "file").touch()
+    with pytest.raises(UserError):
+        HostIndex([infra])
+
+
+@pytest.fixture
+def config_repo(tmp_path, monkeypatch):
+    """Bootstrap config pointing to a local config repo with some hosts."""
+    repo = tmp_path / "repo"
+    hosts = repo / "infrastructure" / "infra" / "hosts"
+    host_configs = {
+        "good": "vars: {x: 1}\n",
+        "bad1": "users: 1\n",
+        "bad2": "infrastructure_name: 3\nvars: []\n",
+    }
+    for host, content in host_configs.items():
+        (hosts / host).mkdir(parents=True)
+        (hosts / host / "kisiac.yaml").write_text(content)
+    # system files of all hosts, one of them overridden by the host good
+    system_files = {
+        "all/system_files/etc/motd": "all\n",
+        "all/system_files/etc/issue": "all\n",
+        "good/system_files/etc/motd": "good\n",
+    }
+    for path, content in system_files.items():
+        (hosts / path).parent.mkdir(parents=True, exist_ok=True)
+        (hosts / path).write_text(content)
+    sp.run(["git", "init", "-q", repo], check=True)
+    sp.run(["git", "-C", repo, "add", "."], check=True)
+    sp.run(
+        ["git", "-C", repo, "-c", "user.name=t", "-c", "user.email=t@t"]
+        + ["commit", "-q", "-m", "init"],
+        check=True,
+    )
+    bootstrap = tmp_path / "kisiac.yaml"
+    bootstrap.write_text(
+        f"repo: file://{repo}\n"
+        "infrastructure: infra\n"
+        "infrastructure_name: test\n"
+        "users: {}\n"
+        "user_software: []\n"
+    )
+    monkeypatch.setattr(config, "config_file_path", bootstrap)
+    monkeypatch.setattr(config, "cache", tmp_path / "cache")
+    monkeypatch.setattr(config, "config_cache", tmp_path / "cache" / "config")
+    monkeypatch.setattr(config, "yaml_cache", tmp_path / "cache" / "yaml")
+    monkeypatch.setattr(Config, "_instance", None, raising=False)
+    monkeypatch.setattr(YamlCache, "_instance", None, raising=False)
+    return Config.get_instance()
+
+
+def commit_all(repo: Path) -> str:
+    """Commit all changes of the given repo, returning the new commit."""
+    git = ["git", "-C", repo, "-c", "user.name=t", "-c", "user.email=t@t"]
+    sp.run([*git, "add", "."], check=True)
+    sp.run([*git, "commit", "-q", "-m", "change"], check=True)
+    return sp.run(
+        [*git, "rev-parse", "HEAD"], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def test_config_errors_of_all_hosts(config_repo):
+    assert config_repo.for_hosts(["good"])["good"].snapshot.vars == {"x": 1}
+    with pytest.raises(UserError) as e:
+        config_repo.for_hosts(["good", "bad1", "bad2"])
+    lines = str(e.value).splitlines()
+    assert any(line.startswith("bad1: ") for line in lines)
+    assert any(line.startswith("bad2: ") for line in lines)
+    assert not any(line.startswith("good: ") for line in lines)
+
+
+def test_repo_config_cache_invalidation(config_repo, tmp_path, monkeypatch):
+    def misses(config: Config) -> int:
+        before = config.cache_stats["misses"]
+        config.repo_config("good")
+        return config.cache_stats["misses"] - before
+
+    assert misses(config_repo) == 1
+    assert misses(config_repo) == 0
+
+    # a new commit of the repo, fetched by a later run
+    repo = tmp_path / "repo"
+    host_config = repo / "infrastructure/infra/hosts/good/kisiac.yaml"
+    host_config.write_text("vars: {x: 2}\n")
+    commit_all(repo)
+    monkeypatch.setattr(GlobalSettings.get_instance(), "fetch_ttl", 0)
+    monkeypatch.setattr(Config, "_instance", None)
+    assert misses(Config.get_instance()) == 1
+    assert Config.get_instance().repo_config("good")["vars"] == {"x": 2}
+
+    # a changed bootstrap config
+    with open(config.config_file_path, "a") as f:
+        f.write("# changed\n")
+    monkeypatch.setattr(Config, "_instance", None)
+    assert misses(Config.get_instance()) == 1
+    # outdated entries of the host are removed
+    assert len(list((config.config_cache / "good").iterdir())) == 1
+
+
+def test_config_repo_fetches(config_repo, tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    (repo / "infrastructure/infra/hosts/good/kisiac.yaml").write_text("vars: {x: 2}\n")
+    (repo / "infrastructure/other").mkdir()
+    (repo / "infrastructure/other/kisiac.yaml").write_text("vars: {}\n")
+    commit_all(repo)
+    settings = GlobalSettings.get_instance()
+
+    def vars_of_next_run() -> dict:
+        monkeypatch.setattr(Config, "_instance", None)
+        return Config.get_instance().repo_config("good")["vars"]
+
+    # the cache has been refreshed recently
+    monkeypatch.setattr(settings, "fetch_ttl", 3600)
+    assert vars_of_next_run() == {"x": 1}
+    monkeypatch.setattr(settings, "fetch_ttl", 0)
+    monkeypatch.setattr(settings, "offline", True)
+    assert vars_of_next_run() == {"x": 1}
+    monkeypatch.setattr(settings, "offline", False)
+    assert vars_of_next_run() == {"x": 2}
+    # other infrastructures are not checked out
+    repo_cache = Config.get_instance().files.repo_cache
+    assert not (repo_cache / "infrastructure/other").exists()
+
+    monkeypatch.setattr(config, "cache", tmp_path / "empty")
+    monkeypatch.setattr(settings, "offline", True)
+    with pytest.raises(UserError, match="offline"):
+        vars_of_next_run()
+
+
+def test_phases_are_skipped_until_their_inputs_change(
+    config_repo, tmp_path, monkeypatch, no_sudo
+):
+    monkeypatch.setattr(state, "state_db_path", tmp_path / "state.sqlite")
+    monkeypatch.setattr(state, "remote_stamp_dir", tmp_path / "phases")
+    monkeypatch.setattr(
+        UpdateHostSettings, "_instance", UpdateHostSettings(), raising=False
+    )
+    monkeypatch.setattr(GlobalSettings.get_instance(), "fetch_ttl", 0)
+    host_config = tmp_path / "repo/infrastructure/infra/hosts/good/kisiac.yaml"
+    phase = "update_filesystems"
+
+    def next_run(content: str | None = None) -> tuple[StateStore, str | None]:
+        if content is not None:
+            host_config.write_text(content)
+            commit_all(tmp_path / "repo")
+        monkeypatch.setattr(Config, "_instance", None)
+        monkeypatch.setattr(StateStore, "_instance", None, raising=False)
+        store = StateStore.get_instance()
+        return store, store.phase_fingerprint("good", phase)
+
+    store, fingerprint = next_run()
+    assert not store.skip_phase("good", phase, fingerprint)
+    store.record_phase("good", phase, fingerprint)
+    assert store.skip_phase("good", phase, fingerprint)
+
+    # sections the phase does not depend on keep the fingerprint
+    store, fingerprint = next_run("vars: {x: 2}\n")
+    assert store.skip_phase("good", phase, fingerprint)
+
+    store, changed = next_run("vars: {x: 2}\nfilesystems: []\n")
+    assert changed != fingerprint
+    assert not store.skip_phase("good", phase, changed)
+    fingerprint = changed
+    store.record_phase("good", phase, fingerprint)
+
+    # a host that lost its stamps (e.g. reinstalled) gets the phase again
+    (tmp_path / "phases" / phase).unlink()
+    store, fingerprint = next_run()
+    assert not store.skip_phase("good", phase, fingerprint)
+
+
+def test_host_files_override_all(config_repo):
+    files = {
+        file.target_path: file.content
+        for file in config_repo.files.get_files(user=None, host="good")
+    }
+    assert files == {Path("etc/motd"): "good\n", Path("etc/issue"): "all\n"}
+
+
+def test_removed_host_file_redeploys_all_file(config_repo):
+    files = config_repo.files
+    host_file = (
+        files.repo_cache / "infrastructure/infra/hosts/good/system_files/etc/motd"
+    )
+    host_file.unlink()
+    changes = Changes(
+        paths=frozenset([host_file]),
+        sections=frozenset(),
+        vars=frozenset(),
+        user_vars={},
+    )
+    deployed = {
+        file.target_path: file.content
+        for file in files.get_files(user=None, host="good", changes=changes)
+    }
+    assert deployed == {Path("etc/motd"): "all\n"}
+
+
+def test_changed_paths_follow_includes(config_repo):
+    files = config_repo.files
+    good = files.repo_cache / "infrastructure/infra/hosts/good"
+    (good / "inc").mkdir()
+    (good / "inc" / "part.j2").write_text("part 1\n")
+    (good / "system_files/etc/app.conf.j2").write_text('{% include "inc/part.j2" %}')
+
+    deployed = commit_all(files.repo_cache)
+    (good / "inc" / "part.j2").write_text("part 2\n")
+    commit_all(files.repo_cache)
+
+    paths = files.changed_paths(deployed)
+    assert paths == {good / "inc" / "part.j2"}
+    changes = Changes(
+        paths=frozenset(paths), sections=frozenset(), vars=frozenset(), user_vars={}
+    )
+    # only the template including the changed one is rendered again
+    assert [
+        (file.target_path, file.content)
+        for file in files.get_files(user=None, host="good", changes=changes)
+    ] == [(Path("etc/app.conf.j2"), "part 2")]
+    assert files.changed_paths("0" * 40) is None
+
+
+def test_renders_are_shared_by_equal_referenced_vars(config_repo, monkeypatch):
+    files = config_repo.files
+    good = files.repo_cache / "infrastructure/infra/hosts/good"
+    (good / "inc").mkdir()
+    (good / "inc" / "part.j2").write_text("{{ shell }}\n")
+    template = good / "user_files" / "rc.j2"
+    template.parent.mkdir()
+    template.write_text('{{ editor }} {% include "inc/part.j2" %}')
+    assert files.referenced_vars(good, template) == {"editor", "shell"}
+
+    rendered = []
+    render = config.Files._render
+
+    def count(self, host, path, vars, used):
+        rendered.append(vars["username"])
+        return render(self, host, path, vars, used)
+
+    monkeypatch.setattr(config.Files, "_render", count)
+    shared = {"editor": "vim", "shell": "bash"}
+    # unreferenced variables like the username do not cause a new render
+    assert files.render(good, template, {**shared, "username": "a"}) == "vim bash"
+    assert files.render(good, template, {**shared, "username": "b"}) == "vim bash"
+    assert rendered == ["a"]
+    # but any variable of an included template does
+    changed = {**shared, "shell": "zsh", "username": "c"}
+    assert files.render(good, template, changed) == "vim zsh"
+    assert rendered == ["a", "c"]
+
+
+def test_templates_are_compiled_once(config_repo, monkeypatch):
+    files = config_repo.files
+    good = files.repo_cache / "infrastructure/infra/hosts/good"
+    (good / "motd.j2").write_text("{{ greeting }}")
+    assert files.templates(good) is files.templates(good)
+    assert files.templates(good).get_template("motd.j2").render(greeting="hi") == "hi"
+
+    # later runs load the compiled template from the bytecode cache
+    def fail(*args, **kwargs):
+        raise AssertionError("compiled again")
+
+    monkeypatch.setattr(jinja2.Environment, "compile", fail)
+    monkeypatch.setattr(Config, "_instance", None)
+    files = Config.get_instance().files
+    assert files.templates(good).get_template("motd.j2").render(greeting="hi") == "hi"
+
+
+def test_kisiac_sh_checks_software_only_if_changed(config_repo, tmp_path):
+    script = tmp_path / "kisiac.sh"
+    script.write_text(config_repo.files.kisiac_sh("good").content)
+    home, bin_dir = tmp_path / "home", tmp_path / "bin"
+    home.mkdir()
+    bin_dir.mkdir()
+    # installing pixi only records that it has been attempted
+    (bin_dir / "curl").write_text(f"#!/bin/sh\ntouch {tmp_path / 'installed'}\n")
+    (bin_dir / "curl").chmod(0o755)
+
+    def login() -> str:
+        return sp.run(
+            ["bash", "--norc", "--noprofile", "-i", "-c", f". {script}"],
+            env={"HOME": str(home), "PATH": f"{bin_dir}:/usr/bin:/bin"},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+
+    assert "Please relogin" in login()
+    assert (tmp_path / "installed").exists()
+    (bin_dir / "pixi").symlink_to("/bin/true")
+    assert "Welcome to test" in login()
+    stamp = home / ".cache/kisiac/software"
+    assert stamp.exists()
+
+    # with an up to date stamp, the commands are not checked anymore
+    (bin_dir / "pixi").unlink()
+    assert "Installing" not in login()
+    stamp.write_text("outdated\n")
+    assert "Installing pixi" in login()
+
+
+def test_plan_files():
+    ownership = Ownership(owner="root", group="root", file_mode=0o644, dir_mode=0o755)
+    existing = PathStat(is_dir=False, mode=0o600, owner="u", group="g", size=4)
+    directory = PathStat(is_dir=True, mode=0o755, owner="root", group="root", size=0)
+    same, changed, new = Path("/etc/same"), Path("/etc/changed"), Path("/etc/a/new")
+    files = [
+        (File(same, "same\n"), ownership),
+        (File(changed, "all\n"), ownership),
+        (File(new, "new\n"), ownership),
+        # the last file for a target wins, like the last layer of a host stack
+        (File(changed, "host\n"), ownership),
+    ]
+    stats = {
+        Path("/"): directory,
+        Path("/etc"): directory,
+        Path("/etc/a"): None,
+        same: existing,
+        changed: existing,
+        new: None,
+    }
+    digests = {same: files[0][0].digest, changed: "outdated"}
+
+    entries, written = plan_files(files, True, stats, digests)
+    assert written == [changed, new]
+    assert entries == [
+        # existing files keep their mode and owner
+        ArchiveEntry(path=changed, content="host\n", mode=0o600, owner="u", group="g"),
+        ArchiveEntry(
+            path=Path("/etc/a"), content=None, mode=0o755, owner="root", group="root"
+        ),
+        ArchiveEntry(path=new, content="new\n", mode=0o644, owner="root", group="root"),
+    ]
+
+    entries, written = plan_files(files, False, stats, digests)
+    assert written == [changed.with_suffix(".updated"), new]
+    assert entries[0].path == changed.with_suffix(".updated")
+    assert entries[0].mode == 0o644
+
+
+def test_push_archive_keeps_symlinks(tmp_path):
+    owner = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    (tmp_path / "real").mkdir()
+    (tmp_path / "real" / "conf").write_text("old\n")
+    (tmp_path / "conf").symlink_to(tmp_path / "real" / "conf")
+    (tmp_path / "dir").symlink_to(tmp_path / "real")
+
+    push_archive(
+        [
+            ArchiveEntry(tmp_path / "conf", "new\n", 0o640, owner, group),
+            ArchiveEntry(tmp_path / "dir", None, 0o750, owner, group),
+            ArchiveEntry(tmp_path / "new", None, 0o700, owner, group),
+            ArchiveEntry(tmp_path / "new" / "file", "file\n", 0o600, owner, group),
+        ],
+        host="localhost",
+        sudo=False,
+    )
+    # the symlinks are kept and their targets are written
+    assert (tmp_path / "conf").is_symlink()
+    assert (tmp_path / "real" / "conf").read_text() == "new\n"
+    assert (tmp_path / "real" / "conf").stat().st_mode & 0o777 == 0o640
+    assert (tmp_path / "dir").is_symlink()
+    assert (tmp_path / "real").stat().st_mode & 0o777 == 0o750
+    assert (tmp_path / "new").stat().st_mode & 0o777 == 0o700
+    assert (tmp_path / "new" / "file").read_text() == "file\n"
+
+
+def test_config_snapshot_errors():
+    with pytest.raises(UserError) as e:
+        ConfigSnapshot.from_config({"infrastructure_name": 3, "vars": []})
+    # all problems are reported at once
+    assert "infrastructure_name" in str(e.value)
+    assert "vars" in str(e.value)
+
+
+def test_package_state_missing():
+    state = PackageState(installed={"curl": "8.0-1", "git": "1:2.39-1"}, index_age=10)
+    packages = [
+        "git",
+        "curl=8.0-1",
+        "vim",
+        "git=1:2.40-1",
+        "curl:amd64",
+        "htop:amd64=3.2",
+    ]
+    assert state.missing(packages) == ["git=1:2.40-1", "htop:amd64=3.2", "vim"]
+    assert state.drift(["vim", "git=1:2.40-1"]) == [
+        "git (installed 1:2.39-1, requested 1:2.40-1)",
+        "vim (not installed)",
+    ]
+    assert state.missing([]) == []
+
+
+def make_deb(path, name, version):
+    """Write a minimal .deb package without any contents."""
+
+    def tar_gz(files):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            for member, content in files.items():
+                info = tarfile.TarInfo(member)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return buffer.getvalue()
+
+    control = (
+        f"Package: {name}\nVersion: {version}\nArchitecture: all\n"
+        "Maintainer: t <t@t>\nDescription: test\n more\n"
+    ).encode()
+    members = {
+        "debian-binary": b"2.0\n",
+        "control.tar.gz": tar_gz({"./control": control}),
+        "data.tar.gz": tar_gz({}),
+    }
+    with open(path, "wb") as f:
+        f.write(b"!<arch>\n")
+        for member, content in members.items():
+            header = f"{member:<16}{0:<12}{0:<6}{0:<6}{100644:<8}{len(content):<10}`\n"
+            f.write(header.encode() + content + b"\n" * (len(content) % 2))
+
+
+def test_package_cache_with_repo(tmp_path, monkeypatch):
+    repo = tmp_path / "repo"
+    (repo / "sub").mkdir(parents=True)
+    make_deb(repo / "a_1.0_all.deb", "a", "1.0")
+    make_deb(repo / "sub" / "b_2.0_all.deb", "b", "2.0")
+    monkeypatch.setattr(packages, "cache", tmp_path / "cache")
+    monkeypatch.setattr(PackageCache, "_instance", None, raising=False)
+    monkeypatch.setattr(
+        UpdateHostSettings,
+        "_instance",
+        UpdateHostSettings(package_repo=repo),
+        raising=False,
+    )
+    cache = PackageCache.get_instance()
+
+    # the missing index is generated from the packages
+    stanzas = cache.repo_index(repo).read_text().split("\n\n")
+    fields = [dict(re.findall(r"^(\S+): (.*)$", stanza, re.M)) for stanza in stanzas]
+    assert [(f["Package"], f["Version"], f["Filename"]) for f in fields[:2]] == [
+        ("a", "1.0", "./a_1.0_all.deb"),
+        ("b", "2.0", "./sub/b_2.0_all.deb"),
+    ]
+    assert "Description: test\n more\n" in stanzas[0]
+    # entries as apt-get --print-uris reports them for the pushed index
+    a, b = (
+        PackageDownload.parse(
+            f"'file:{packages.repo_dir}/{f['Filename']}' "
+            f"{f['Filename'].rsplit('/', 1)[-1]} {f['Size']} SHA256:{f['SHA256']}"
+        )
+        for f in fields[:2]
+    )
+
+    path = cache.fetch(b)
+    assert path.read_bytes() == (repo / "sub" / "b_2.0_all.deb").read_bytes()
+    # cache hit, the repo is not read again
+    (repo / "sub" / "b_2.0_all.deb").unlink()
+    assert cache.fetch(b) == path
+
+    assert a.checksum is not None
+    for invalid in [
+        dataclasses.replace(a, checksum=(a.checksum[0], "0" * 64)),
+        dataclasses.replace(a, size=a.size + 1),
+    ]:
+        with pytest.raises(UserError, match="Checksum"):
+            cache.fetch(invalid)
+    # rejected packages are not kept
+    assert [p.name for p in cache.path.iterdir()] == ["b_2.0_all.deb"]
+
+
+def test_yaml_cache_render(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "yaml_cache", tmp_path / "yaml")
+    content = (
+        b"__use_yte__: true\n"
+        b"name: ?name\n"
+        b'list: [1, {a: "multi\\nline"}]\n'
+        b"?if x:\n  flag: true\n"
+    )
+    used = {"name": "n", "x": True}
+    rendered = YamlCache().render(content, used, used)
+    # libyaml produces the same output as the pure Python dumper
+    expected = {"name": "n", "list": [1, {"a": "multi\nline"}], "flag": True}
+    assert rendered == yaml.dump(expected, Dumper=yaml.Dumper, indent=2)
+
+    # later runs take the rendered content from the disk cache
+    def fail(*args):
+        raise AssertionError("rendered again")
+
+    monkeypatch.setattr(YamlCache, "_render", fail)
+    assert YamlCache().render(content, used, used) == rendered
+    with pytest.raises(AssertionError):
+        YamlCache().render(content, {"name": "m", "x": True}, {"name": "m"})